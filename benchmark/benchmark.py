@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+"""
+* Description
+*
+* @author Sven Werlen (sven.werlen@gmail.com)
+* @copyright 2012 Sven Werlen
+* @license GPL v3 (http://www.gnu.org/licenses/gpl.html)
+* @package folder2piwigo
+*
+* Benchmark for folder2piwigo. Generates a synthetic (reproducible) library and
+* synchronizes it to a temp target folder, a local FTP stand-in (fakeftp.py) and/or a local Piwigo stand-in (fakepiwigo.py).
+*
+* Phases (for each target)
+*    sync:   initial synchronization (conversion and upload of all files)
+*    resync: synchronization without changes (sync state)
+*    full:   synchronization without changes (--full, target is checked again)
+*
+* Targets
+*    file: temp target folder
+*    ftp:  temp target folder served by a local FTP stand-in (fakeftp.py, requires pyftpdlib)
+*    api:  local Piwigo stand-in (fakepiwigo.py)
+*
+* Contains
+*    SyntheticLibrary: generates source trees
+*    Benchmark: runs phases and collects measures
+"""
+
+import os
+import sys
+import time
+import json
+import getopt
+import random
+import shutil
+import tempfile
+import subprocess
+
+try:
+   from PIL import Image
+except ImportError:
+   Image = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import folder2piwigo
+from fakepiwigo import FakePiwigoServer
+from fakeftp import FakeFTPServer
+
+
+# ===================================
+# Synthetic source tree
+# ===================================
+class SyntheticLibrary(object):
+
+   folder = None
+   depth = None
+   albums = None
+   images = None
+   sizes = None
+   videos = None
+   seed = None
+
+   # generated files (count/bytes)
+   files = None
+   bytes = None
+
+   def __init__(self, folder, depth, albums, images, sizes, videos, seed):
+      self.folder = folder
+      self.depth = max(1, depth)
+      self.albums = albums
+      self.images = images
+      self.sizes = sizes
+      self.videos = videos
+      self.seed = seed
+      self.files = 0
+      self.bytes = 0
+
+   # ===================================
+   # Generates the tree
+   #  - album k is at depth (k % depth) + 1, under the last album generated one level above
+   #  - images are copies of one template per size with a unique trailer (different checksums)
+   # ===================================
+   def generate(self):
+      rand = random.Random(self.seed)
+      templates = [self.template(size, rand) for size in self.sizes]
+
+      parents = [self.folder]
+      for k in range(self.albums):
+         level = k % self.depth
+         album = os.path.join(parents[level], "album-%03d" % k)
+         os.makedirs(album)
+         parents[level + 1:] = [album]
+
+         for i in range(self.images):
+            data = templates[(k * self.images + i) % len(templates)]
+            self.write(os.path.join(album, "image-%04d.jpg" % i), data + "f2pbench-%d-%d" % (k, i))
+
+         if k < self.videos:
+            self.video(os.path.join(album, "video-%03d.mp4" % k))
+
+   def write(self, path, data):
+      with open(path, 'wb') as f:
+         f.write(data)
+      self.files += 1
+      self.bytes += len(data)
+
+   # ===================================
+   # JPEG template (seeded noise, scaled up like a photo)
+   # ===================================
+   def template(self, size, rand):
+      width, height = [int(v) for v in size.split('x')]
+      fd, path = tempfile.mkstemp(suffix=".jpg")
+      os.close(fd)
+      try:
+         if Image is not None:
+            tile = Image.frombytes('RGB', (64, 48), "".join([chr(rand.randint(0, 255)) for i in range(64 * 48 * 3)]))
+            tile.resize((width, height), Image.BICUBIC).save(path, quality=92)
+         else:
+            subprocess.check_call(["convert", "-seed", str(rand.randint(0, 65535)), "-size", size, "plasma:fractal", "-quality", "92", path])
+         with open(path, 'rb') as f:
+            return f.read()
+      finally:
+         os.remove(path)
+
+   # ===================================
+   # Video (test pattern, requires avconv or ffmpeg)
+   # ===================================
+   def video(self, path):
+      for tool in ("avconv", "ffmpeg"):
+         try:
+            subprocess.check_call([tool, "-loglevel", "quiet", "-f", "lavfi", "-i", "testsrc=duration=5:size=640x480:rate=25", path])
+            self.files += 1
+            self.bytes += os.path.getsize(path)
+            return
+         except (OSError, subprocess.CalledProcessError):
+            pass
+      print "  [WARN] Video '" + path + "' not generated (avconv/ffmpeg required)"
+
+
+# ===================================
+# Benchmark (one library, several targets)
+# ===================================
+class Benchmark(object):
+
+   library = None
+   workFolder = None
+   settings = None
+   verbose = None
+   results = None
+
+   def __init__(self, library, workFolder, settings, verbose = False):
+      self.library = library
+      self.workFolder = workFolder
+      self.settings = settings
+      self.verbose = verbose
+      self.results = []
+
+   # ===================================
+   # Runs all phases for given target (file, ftp or api)
+   # ===================================
+   def run(self, target):
+      if target not in ('file', 'ftp', 'api'):
+         raise ValueError("unknown target '" + target + "' (file, ftp or api)")
+      tempFolder = os.path.join(self.workFolder, target, 'temp')
+      os.makedirs(tempFolder)
+      server = None
+
+      if target in ('file', 'ftp'):
+         targetFolder = os.path.join(self.workFolder, target, 'galleries')
+         os.makedirs(targetFolder)
+         implSettings = {"targetFolder": targetFolder}
+      if target == 'ftp':
+         server = FakeFTPServer(targetFolder, latency = self.settings['latency'])
+         server.start()
+         implSettings = {"host": "127.0.0.1", "port": server.port(), "username": server.username, "password": server.password,
+                         "tls": False, "targetFolder": "/"}
+      elif target == 'api':
+         server = FakePiwigoServer(latency = self.settings['latency'], failureRate = self.settings['failures'] / 100.0,
+                                   sessionRequests = self.settings['session'])
+         server.start()
+         implSettings = {"serviceURL": server.url(), "username": "bench", "password": "bench",
+                         "chunkSize": self.settings['chunkSize'] * 1024, "chunksInFlight": 4, "tempFolder": tempFolder}
+
+      try:
+         for phase, fullCheck in (("sync", False), ("resync", False), ("full", True)):
+            self.phase(target, phase, dict(implSettings), tempFolder, fullCheck, server)
+      finally:
+         if server is not None:
+            server.stop()
+
+   def phase(self, target, phase, implSettings, tempFolder, fullCheck, server):
+      requests = server.requests() if server else 0
+      stdout = sys.stdout
+      if not self.verbose:
+         sys.stdout = open(os.devnull, 'w')
+
+      start = time.time()
+      try:
+         p = folder2piwigo.Folder2Piwigo(target, implSettings, self.library.folder + os.sep, tempFolder, False, False,
+                                         self.settings['resize'], 90, 5, True, fullCheck, self.settings['jobs'],
+                                         self.settings['uploads'], self.settings['engine'])
+         p.run()
+         # logout (API) belongs to the phase
+         del p
+         status = "ok"
+      except (SystemExit, folder2piwigo.PiwigoError):
+         status = "failed"
+      finally:
+         wall = time.time() - start
+         if not self.verbose:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+      files = self.library.files
+      requests = (server.requests() - requests) if server else None
+      self.results.append({
+         'target': target, 'phase': phase, 'status': status, 'wall': wall, 'files': files,
+         'filesPerSecond': files / wall, 'bytesPerSecond': self.library.bytes / wall,
+         'requests': requests, 'requestsPerFile': float(requests) / files if requests is not None else None,
+         'stages': folder2piwigo.metrics.toDict()['stages'] })
+
+   # ===================================
+   # Prints results as a table
+   # ===================================
+   def report(self):
+      print "%-6s %-8s %-7s %9s %10s %10s %10s" % ("target", "phase", "status", "wall (s)", "files/s", "MB/s", "req/file")
+      for r in self.results:
+         reqPerFile = "%10.2f" % r['requestsPerFile'] if r['requestsPerFile'] is not None else "%10s" % "-"
+         print "%-6s %-8s %-7s %9.2f %10.1f %10.2f %s" % (r['target'], r['phase'], r['status'], r['wall'],
+                                                        r['filesPerSecond'], r['bytesPerSecond'] / 1024 / 1024, reqPerFile)
+
+
+# ===================================
+# Usage
+# ===================================
+def usage():
+   print 'Usage: benchmark.py [options]'
+   print '  --depth=N        album depth (default 2)'
+   print '  --albums=N       number of albums (default 10)'
+   print '  --images=N       images per album (default 20)'
+   print '  --sizes=WxH,...  image sizes (default 2048x1536)'
+   print '  --videos=N       number of videos (default 0)'
+   print '  --seed=N         random seed (default 42)'
+   print '  --targets=LIST   file,ftp,api (default file,api, ftp requires pyftpdlib)'
+   print '  --resize=WxH     resize option (default 800x600)'
+   print '  --engine=NAME    convert or pil (default convert)'
+   print '  -j, --jobs=N     conversion jobs (default 2)'
+   print '  -u, --uploads=N  upload threads (default 2)'
+   print '  --chunk=KB       API chunk size (default 0)'
+   print '  --latency=MS     fake server latency per request/FTP command (default 0)'
+   print '  --failures=PCT   fake server transient errors (HTTP 502) in percent (default 0)'
+   print '  --session=N      fake server session expires after N requests (default 0 = never)'
+   print '  --json=FILE      write results as JSON'
+   print '  --keep           keep generated files'
+   print '  -v, --verbose    show folder2piwigo output'
+
+
+# ===================================
+# Main
+# ===================================
+def main(argv):
+   settings = {'depth': 2, 'albums': 10, 'images': 20, 'sizes': "2048x1536", 'videos': 0, 'seed': 42,
+               'targets': "file,api", 'resize': "800x600", 'engine': 'convert', 'jobs': 2, 'uploads': 2,
+               'chunkSize': 0, 'latency': 0, 'failures': 0, 'session': 0}
+   jsonFile = None
+   keep = False
+   verbose = False
+
+   try:
+      opts, args = getopt.getopt(argv, "hvj:u:", ["help", "verbose", "keep", "depth=", "albums=", "images=", "sizes=", "videos=",
+                                                  "seed=", "targets=", "resize=", "engine=", "jobs=", "uploads=", "chunk=",
+                                                  "latency=", "failures=", "session=", "json="])
+   except getopt.GetoptError:
+      usage()
+      sys.exit(2)
+   for opt, arg in opts:
+      if opt in ("-h", "--help"):
+         usage()
+         sys.exit()
+      elif opt in ("-v", "--verbose"):
+         verbose = True
+      elif opt == "--keep":
+         keep = True
+      elif opt == "--json":
+         jsonFile = arg
+      elif opt in ("-j", "--jobs"):
+         settings['jobs'] = int(arg)
+      elif opt in ("-u", "--uploads"):
+         settings['uploads'] = int(arg)
+      elif opt == "--chunk":
+         settings['chunkSize'] = int(arg)
+      elif opt in ("--depth", "--albums", "--images", "--videos", "--seed", "--latency", "--failures", "--session"):
+         settings[opt[2:]] = int(arg)
+      else:
+         settings[opt[2:]] = arg
+
+   workFolder = tempfile.mkdtemp(prefix="f2pbench-")
+   try:
+      sourceFolder = os.path.join(workFolder, 'source')
+      os.makedirs(sourceFolder)
+      library = SyntheticLibrary(sourceFolder, settings['depth'], settings['albums'], settings['images'],
+                                 settings['sizes'].split(','), settings['videos'], settings['seed'])
+      start = time.time()
+      library.generate()
+      print "Generated %d files (%.1f MB) in %.2fs (%s)" % (library.files, library.bytes / 1024.0 / 1024, time.time() - start, workFolder)
+
+      bench = Benchmark(library, workFolder, settings, verbose)
+      for target in settings['targets'].split(','):
+         bench.run(target)
+      bench.report()
+
+      if jsonFile:
+         with open(jsonFile, 'w') as f:
+            json.dump({'settings': settings, 'files': library.files, 'bytes': library.bytes, 'results': bench.results}, f, indent=2)
+   finally:
+      if not keep:
+         shutil.rmtree(workFolder, ignore_errors=True)
+
+
+# ===================================
+# Main exec
+# ===================================
+if __name__ == "__main__":
+   main(sys.argv[1:])
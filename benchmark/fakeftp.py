@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+"""
+* Description
+*
+* @author Sven Werlen (sven.werlen@gmail.com)
+* @copyright 2012 Sven Werlen
+* @license GPL v3 (http://www.gnu.org/licenses/gpl.html)
+* @package folder2piwigo
+*
+* Local FTP stand-in, used for benchmarks (requires pyftpdlib).
+* Serves a local folder (one user) and counts FTP commands.
+* Can simulate latency.
+*
+* Contains
+*    FakeFTPHandler: FTP command handler (counters, latency)
+*    FakeFTPServer: threaded FTP server
+"""
+
+import sys
+import time
+import logging
+import threading
+
+try:
+   from pyftpdlib.authorizers import DummyAuthorizer
+   from pyftpdlib.handlers import FTPHandler
+   from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+   FTPHandler = None
+
+# no server logs (same as the fake Piwigo)
+logging.getLogger('pyftpdlib').addHandler(logging.NullHandler())
+logging.getLogger('pyftpdlib').propagate = False
+
+
+# ===================================
+# FTP command handler (one thread per connection)
+# ===================================
+if FTPHandler is not None:
+   class FakeFTPHandler(FTPHandler):
+
+      def pre_process_command(self, line, cmd, arg):
+         self.server.count()
+
+         # simulated network/server latency
+         if self.server.latency > 0:
+            time.sleep(self.server.latency / 1000.0)
+         FTPHandler.pre_process_command(self, line, cmd, arg)
+
+
+# ===================================
+# Threaded FTP server (runs in background)
+# ===================================
+class FakeFTPServer(object):
+
+   username = "bench"
+   password = "bench"
+
+   def __init__(self, folder, port = 0, latency = 0):
+      if FTPHandler is None:
+         raise ImportError("pyftpdlib is required for the FTP stand-in")
+      users = DummyAuthorizer()
+      users.add_user(self.username, self.password, folder, perm='elradfmwMT')
+      class Handler(FakeFTPHandler):
+         authorizer = users
+      self.server = ThreadedFTPServer(('127.0.0.1', port), Handler)
+      self.server.latency = latency
+      self.server.count = self.count
+      self.lock = threading.Lock()
+      self.calls = 0
+      self.stopped = threading.Event()
+      self.thread = None
+
+   def count(self):
+      with self.lock:
+         self.calls += 1
+
+   def requests(self):
+      with self.lock:
+         return self.calls
+
+   def port(self):
+      return self.server.address[1]
+
+   def start(self):
+      self.thread = threading.Thread(target=self.serve)
+      self.thread.daemon = True
+      self.thread.start()
+
+   # loops until stopped (pyftpdlib can't be stopped from another thread)
+   def serve(self):
+      while not self.stopped.is_set():
+         self.server.serve_forever(timeout=0.2, blocking=False, handle_exit=False)
+      self.server.close_all()
+
+   def stop(self):
+      self.stopped.set()
+      if self.thread is not None:
+         self.thread.join()
+
+
+# ===================================
+# Main exec (standalone server)
+# ===================================
+if __name__ == "__main__":
+   folder = sys.argv[1] if len(sys.argv) > 1 else "."
+   port = int(sys.argv[2]) if len(sys.argv) > 2 else 2121
+   server = FakeFTPServer(folder, port)
+   print 'Fake FTP listening on 127.0.0.1:' + str(server.port()) + ' (user ' + server.username + ', password ' + server.password + ')'
+   server.start()
+   try:
+      while True:
+         time.sleep(1)
+   except KeyboardInterrupt:
+      server.stop()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+"""
+* Description
+*
+* @author Sven Werlen (sven.werlen@gmail.com)
+* @copyright 2012 Sven Werlen
+* @license GPL v3 (http://www.gnu.org/licenses/gpl.html)
+* @package folder2piwigo
+*
+* Local stand-in for Piwigo web services (ws.php), used for benchmarks.
+* Implements the methods used by APIPiwigoClient and keeps everything in memory.
+* Can simulate latency, transient errors (HTTP 502) and expiring sessions.
+*
+* Contains
+*    FakePiwigo: in-memory gallery and request counters
+*    FakePiwigoHandler: HTTP request handler
+*    FakePiwigoServer: threaded HTTP server
+"""
+
+import sys
+import cgi
+import json
+import time
+import random
+import base64
+import hashlib
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+
+# ===================================
+# In-memory gallery
+# ===================================
+class FakePiwigo(object):
+
+   def __init__(self, latency = 0, failureRate = 0, sessionRequests = 0):
+      self.latency = latency
+      self.failureRate = failureRate
+      self.sessionRequests = sessionRequests
+      self.lock = threading.Lock()
+      self.reset()
+
+   def reset(self):
+      with self.lock:
+         self.nextId = 1
+         self.categories = {}
+         self.images = {}
+         self.chunks = {}
+         self.calls = {}
+         self.bytesReceived = 0
+         self.session = None
+
+   def requests(self):
+      with self.lock:
+         return sum(self.calls.values())
+
+   # ===================================
+   # Returns True if request randomly fails (transient error)
+   # ===================================
+   def fails(self):
+      with self.lock:
+         return random.random() < self.failureRate
+
+   # ===================================
+   # Executes a web service method (returns result or raises ValueError)
+   # Sessions expire after sessionRequests requests (raises LookupError)
+   # ===================================
+   def call(self, method, form):
+      get = lambda k: form.getvalue(k)
+      
+      with self.lock:
+         self.calls[method] = self.calls.get(method, 0) + 1
+         
+         if method == 'pwg.session.login':
+            self.session = 0
+            return True
+         elif method == 'pwg.session.logout':
+            self.session = None
+            return True
+         
+         if self.session is None:
+            raise LookupError('Access denied')
+         self.session += 1
+         if self.sessionRequests > 0 and self.session > self.sessionRequests:
+            self.session = None
+            raise LookupError('Access denied')
+         
+         if method == 'pwg.session.getStatus':         
+            return {'pwg_token': 'token'}
+         
+         elif method == 'pwg.categories.getList':
+            catId = int(get('cat_id') or 0)
+            recursive = get('recursive') in ('true', '1')
+            return {'categories': [dict(c) for c in self.categories.values() if recursive or (c['id_uppercat'] or 0) == catId]}
+         
+         elif method == 'pwg.categories.add':
+            parent = int(get('parent')) if get('parent') else None
+            catId = self.newId()
+            uppercats = (self.categories[parent]['uppercats'] + ',' if parent else '') + str(catId)
+            self.categories[catId] = {'id': catId, 'name': get('name'), 'id_uppercat': parent, 'uppercats': uppercats}
+            return {'id': catId}
+         
+         elif method == 'pwg.categories.getImages':
+            catId = int(get('cat_id'))
+            images = [{'id': i, 'name': img['name'], 'categories': [{'id': c} for c in img['categories']]}
+                      for i, img in self.images.items() if catId in img['categories']]
+            return {'images': {'_content': images}}
+         
+         elif method == 'pwg.images.addSimple':
+            data = form['image'].file.read()
+            return {'image_id': self.addImage(get('image_id'), get('name'), [int(get('category'))], data)}
+         
+         elif method == 'pwg.images.addChunk':
+            self.chunks.setdefault(get('original_sum'), {})[int(get('position'))] = base64.b64decode(get('data'))
+            return True
+         
+         elif method == 'pwg.images.add':
+            chunks = self.chunks.pop(get('original_sum'), {})
+            data = "".join([chunks[p] for p in sorted(chunks)])
+            if hashlib.md5(data).hexdigest() != get('original_sum'):
+               raise ValueError('invalid checksum')
+            categories = [int(c) for c in get('categories').split(';')[0].split(',')]
+            return {'image_id': self.addImage(get('image_id'), get('name'), categories, data)}
+         
+         elif method == 'pwg.images.exist':
+            result = {}
+            for md5 in (get('md5sum_list') or '').split(','):
+               result[md5] = next((i for i, img in self.images.items() if img['md5'] == md5), None)
+            return result
+         
+         elif method == 'pwg.images.setInfo':
+            image = self.images[int(get('image_id'))]
+            categories = [int(c) for c in (get('categories') or '').split(';') if c]
+            if get('multiple_value_mode') == 'replace':
+               image['categories'] = categories
+            else:
+               image['categories'] = sorted(set(image['categories'] + categories))
+            return True
+         
+         elif method == 'pwg.images.delete':
+            for i in str(get('image_id')).replace(';', ',').split(','):
+               self.images.pop(int(i), None)
+            return True
+         
+         raise ValueError('unknown method ' + method)
+
+   def newId(self):
+      newId = self.nextId
+      self.nextId += 1
+      return newId
+
+   def addImage(self, imageId, name, categories, data):
+      self.bytesReceived += len(data)
+      imageId = int(imageId) if imageId else self.newId()
+      self.images[imageId] = {'name': name, 'categories': categories, 'md5': hashlib.md5(data).hexdigest()}
+      return imageId
+
+
+# ===================================
+# HTTP request handler (ws.php)
+# ===================================
+class FakePiwigoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+   protocol_version = 'HTTP/1.1'
+
+   def log_message(self, format, *args):
+      pass
+
+   def do_POST(self):
+      params = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+      method = params.get('method', [''])[0]
+      environ = {'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': self.headers.get('Content-Type', 'application/x-www-form-urlencoded')}
+      form = cgi.FieldStorage(fp=self.rfile, headers=self.headers, environ=environ)
+      
+      # simulated network/server latency
+      if self.server.piwigo.latency > 0:
+         time.sleep(self.server.piwigo.latency / 1000.0)
+      
+      # transient error (overloaded server)
+      if self.server.piwigo.fails():
+         body = "<html><body>502 Bad Gateway</body></html>"
+         self.send_response(502)
+         self.send_header('Content-Type', 'text/html')
+         self.send_header('Content-Length', str(len(body)))
+         self.end_headers()
+         self.wfile.write(body)
+         return
+      
+      try:
+         body = json.dumps({'stat': 'ok', 'result': self.server.piwigo.call(method, form)})
+      except LookupError as e:
+         body = json.dumps({'stat': 'fail', 'err': 401, 'message': str(e)})
+      except (ValueError, KeyError) as e:
+         body = json.dumps({'stat': 'fail', 'err': 1002, 'message': str(e)})
+      
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.send_header('Set-Cookie', 'pwg_id=fakepiwigo; path=/')
+      self.end_headers()
+      self.wfile.write(body)
+
+
+# ===================================
+# Threaded HTTP server (runs in background)
+# ===================================
+class FakePiwigoServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+   daemon_threads = True
+
+   def __init__(self, port = 0, latency = 0, failureRate = 0, sessionRequests = 0):
+      BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), FakePiwigoHandler)
+      self.piwigo = FakePiwigo(latency, failureRate, sessionRequests)
+
+   def url(self):
+      return "http://127.0.0.1:" + str(self.server_address[1])
+
+   def start(self):
+      thread = threading.Thread(target=self.serve_forever)
+      thread.daemon = True
+      thread.start()
+
+   def stop(self):
+      self.shutdown()
+      self.server_close()
+
+   def requests(self):
+      return self.piwigo.requests()
+
+
+# ===================================
+# Main exec (standalone server)
+# ===================================
+if __name__ == "__main__":
+   port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+   server = FakePiwigoServer(port)
+   print 'Fake Piwigo listening on ' + server.url() + '/ws.php'
+   server.serve_forever()
@@ -10,9 +10,16 @@
 * @version 1.1 - 2013-01-13
 *
 * Contains
+*    PiwigoError: error returned by Piwigo
 *    AbstractPiwigoClient: client interface
 *    - PiwigoFileClient: file client implementation (FTP synchronization)
+*      - PiwigoFTPClient: ftp client implementation (FTP synchronization without mount)
 *    - PiwigoAPIClient: api client implementation (web api)
+*      - AdaptiveLimit: concurrency limit of web api requests
+*    SyncState: local index of already synchronized files
+*    DerivativeCache: cache of converted images and videos
+*    DirEntry: directory entry (when scandir is not available)
+*    Metrics: durations, bytes and errors per stage
 *    Folder2Piwigo: main class
 *    main(), usage(), etc...: a few global utility functions
 """
@@ -25,14 +32,71 @@ import signal
 import shutil
 import re
 import time
+import random
 import json
+import base64
+import hashlib
+import sqlite3
+import tempfile
+import subprocess
+import ftplib
+import contextlib
+import threading
+import Queue
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import requests
 from ConfigParser import SafeConfigParser
 
+# scandir provides the file type along with the name (no stat call per entry)
+try:
+   from os import scandir
+except ImportError:
+   try:
+      from scandir import scandir
+   except ImportError:
+      scandir = None
+
+# pyinotify enables the watch mode (Linux only)
+try:
+   import pyinotify
+except ImportError:
+   pyinotify = None
+
+# PIL (Pillow) enables the in-process image engine
+try:
+   from PIL import Image
+except ImportError:
+   Image = None
+
 # Global constants
 SCRIPTNAME = "folder2piwigo"
 VERSION = "1.1"
 
+# Supported files
+IMAGE_EXTENSIONS = [".jpg",".jpeg",".gif",".png"]
+VIDEO_EXTENSIONS = [".ogv",".ogg",".mp4"]
+
+# Piwigo derivative types and their default sizes (square is cropped)
+DERIVATIVE_SIZES = {"sq": (120, 120), "th": (144, 144), "2s": (240, 240), "xs": (432, 324), "sm": (576, 432),
+                    "me": (792, 594), "la": (1008, 756), "xl": (1224, 918), "xx": (1656, 1242)}
+
+
+
+
+# ===================================
+# Error returned by Piwigo (or communication error after all retries)
+# ===================================
+class PiwigoError(Exception):
+   pass
+
+# ===================================
+# Error of a conversion tool (file is skipped and synchronized again next time)
+# ===================================
+class ConversionError(Exception):
+   pass
+
 
 
 
@@ -41,6 +105,9 @@ VERSION = "1.1"
 # ===================================
 class AbstractPiwigoClient(object):
 
+   # uploaded images can be found by checksum (see imagesExist)
+   checksums = False
+
    def __init__(self,settings):
       pass
 
@@ -54,14 +121,37 @@ class AbstractPiwigoClient(object):
    def fileExists(self, category, filename):
       pass
    
-   def addImage(self, file, category, filename):
+   # Returns the reference of a file on target (same as returned by addImage/addOther)
+   def fileReference(self, category, filename):
+      return None
+   
+   def addImage(self, file, category, filename, imageId = None):
       pass
 
    def addOther(self, file, representative, category, filename, ):
       pass
    
+   # Adds derivatives [(type, file)] of an image (see DERIVATIVE_SIZES)
+   def addDerivatives(self, derivatives, category, filename, replace = False):
+      pass
+   
+   def imagesExist(self, checksums):
+      return {}
+   
+   def linkImage(self, imageId, category):
+      pass
+   
+   # Returns elements to delete [(category, name, reference)]
    def cleanCategory(self, category, fileList):
       pass
+   
+   # Deletes elements returned by cleanCategory (returns number of deleted elements)
+   def deleteElements(self, elements):
+      pass
+   
+   # Forgets cached listings (target may have changed since)
+   def refresh(self):
+      pass
 
 
 
@@ -75,9 +165,20 @@ class PiwigoFileClient(AbstractPiwigoClient):
    # target folder
    target = None
    
+   # listings of target categories (converted names), shared by upload threads
+   listings = None
+   lock = None
+   
+   # copies of videos and their representatives
+   copyPool = None
+   
 
    def __init__(self,settings):
       self.target = settings['targetFolder']
+      self.dataFolder = settings.get('dataFolder')
+      self.listings = {}
+      self.lock = threading.Lock()
+      self.copyPool = ThreadPool(2)
       
       # check that target folder exists
       if self.target is None:
@@ -106,6 +207,9 @@ class PiwigoFileClient(AbstractPiwigoClient):
 
 
    def convertCategoryPath(self, path):
+      # derivative folders are relative to target folder and already converted (see derivativeCategory)
+      if self.dataFolder is not None and (path + "/").startswith(self.derivativeRoot() + "/"):
+         return os.path.join(self.target, path)
       category = self.convertPath(path)
       return os.path.join(self.target, category)
 
@@ -119,13 +223,62 @@ class PiwigoFileClient(AbstractPiwigoClient):
       return os.path.exists(self.convertCategoryPath(category))
       
    def addCategory(self, category):
-      os.mkdir(self.convertCategoryPath(category))
+      try:
+         os.mkdir(self.convertCategoryPath(category))
+      except OSError:
+         # could have been created by another thread in the meantime
+         if not self.categoryExists(category):
+            raise
+
+   # Lists a target category once (existence checks don't access the target anymore)
+   def listCategory(self, category):
+      with self.lock:
+         if not category in self.listings:
+            folder = self.convertCategoryPath(category)
+            self.listings[category] = set(os.listdir(folder)) if os.path.isdir(folder) else set([])
+         return self.listings[category]
 
    def fileExists(self, category, filename):
-      return os.path.exists(self.convertFilePath(category, filename))
+      return self.convertPath(filename) in self.listCategory(category)
+   
+   def fileReference(self, category, filename):
+      return self.convertFilePath(category, filename)
    
-   def addImage(self, file, category, filename):
-      shutil.copy(file, self.convertFilePath(category, filename))
+   def refresh(self):
+      with self.lock:
+         self.listings = {}
+   
+   # Copies a file (path or file object) into a category (temporary name, then renamed)
+   # Files already on target with same size are not copied again (unless replaced)
+   def copyFile(self, file, category, filename, replace = False):
+      tFile = self.convertFilePath(category, filename)
+      tName = os.path.basename(tFile)
+      if not replace and tName in self.listCategory(category) and os.path.getsize(tFile) == fileSize(file):
+         return tFile
+      
+      tTemp = os.path.join(os.path.dirname(tFile), "." + tName + ".part")
+      try:
+         with metrics.measure('copy', 'file'):
+            with openFile(file) as src, open(tTemp, 'wb') as dest:
+               shutil.copyfileobj(src, dest, 1024 * 1024)
+            os.rename(tTemp, tFile)
+      except (IOError, OSError):
+         # could happen with big files => no half-written file on target
+         if os.path.exists(tTemp):
+            os.remove(tTemp)
+         raise
+      metrics.add('copy', 'file', bytes = os.path.getsize(tFile))
+      
+      with self.lock:
+         self.listings.setdefault(category, set([])).add(tName)
+      return tFile
+   
+   def addImage(self, file, category, filename, imageId = None):
+      try:
+         return self.copyFile(file, category, filename, imageId is not None)
+      except (IOError, OSError) as e:
+         print "  [WARN] Image '" + filename + "' couldn't be copied (" + str(e) + ")"
+         return None
 
    def addOther(self, file, representative, category, filename):
       # generate representative path and name
@@ -137,36 +290,49 @@ class PiwigoFileClient(AbstractPiwigoClient):
       if not self.categoryExists(rFolder):
          self.addCategory(rFolder)
       
-      tRepresentative = self.convertFilePath(rFolder, rFilename)
-      tFile = self.convertFilePath(category, filename)
-      
-      # copy files
+      # copy files (in parallel)
       try:
-         shutil.copy(representative, tRepresentative)
-         shutil.copy(file, tFile)
-      except IOError:
-         # could happen with big files
-         # check if file size is the same => if not, remove target file
-         statinfo1 = os.stat(representative)
-         statinfo2 = os.stat(tRepresentative)
-         if not statinfo1.st_size == statinfo2.st_size:
-            os.remove(tRepresentative)
-         statinfo1 = os.stat(file)
-         statinfo2 = os.stat(tFile)
-         if not statinfo1.st_size == statinfo2.st_size:
-            os.remove(tFile)
-         
-         
-
-   def cleanCategory(self, category, fileList, prompt):
+         results = [self.copyPool.apply_async(self.copyFile, args) for args in [(representative, rFolder, rFilename), (file, category, filename)]]
+         return [r.get() for r in results][1]
+      except (IOError, OSError) as e:
+         print "  [WARN] Video '" + filename + "' couldn't be copied (" + str(e) + ")"
+         return None
+   
+   # Derivatives are stored in the data folder (PWG_HOME/_data/i/galleries/<category>/<name>-<type>.<ext>)
+   # Piwigo only generates the missing ones (derivatives must be newer than the image)
+   # (paths relative to target folder, data folder can't be derived from target folder)
+   def derivativeRoot(self):
+      return os.path.relpath(self.dataFolder, self.target)
+   
+   def derivativeCategory(self, category):
+      return os.path.join(self.derivativeRoot(), "i", "galleries", self.convertPath(category.strip('/'))).rstrip('/')
+   
+   def addDerivatives(self, derivatives, category, filename, replace = False):
+      dCategory = self.derivativeCategory(category)
+      parts = os.path.relpath(dCategory, self.derivativeRoot()).split('/')
+      name, ext = os.path.splitext(filename)
+      try:
+         # treat derivative folders like categories (created once, data folder must exist)
+         for i in range(1, len(parts) + 1):
+            folder = os.path.join(self.derivativeRoot(), *parts[:i])
+            if not self.categoryExists(folder):
+               self.addCategory(folder)
+         for type, file in derivatives:
+            self.copyFile(file, dCategory, name + "-" + type + ext, replace)
+      except (IOError, OSError) as e:
+         print "  [WARN] Derivatives of '" + filename + "' couldn't be copied (" + str(e) + ")"
+         
+         
+
+   def cleanCategory(self, category, fileList):
       # generate a new list (filename converted)
       newFileList = set([])
       for f in fileList:
          newFileList.add(self.convertPath(f))
          
-      # delete
-      deleted = 0
-      for el in os.listdir(self.convertCategoryPath(category)):
+      # elements to delete
+      elements = []
+      for el in sorted(self.listCategory(category)):
          curPath = self.convertFilePath(category, el)
          
          # ignore system files
@@ -175,27 +341,433 @@ class PiwigoFileClient(AbstractPiwigoClient):
          
          # check file extension
          name, ext = os.path.splitext(curPath)
-         if not ext.lower() in [".jpg",".jpeg",".gif",".png",".mp4",".ogg"]:
+         if not ext.lower() in IMAGE_EXTENSIONS + [".mp4",".ogg"]:
             continue
             
          # check if file was processed
          if not el in newFileList:
-            print "    Element '" + el + "' has no match in source folder. Deleting..."
-            
-            # delete file
-            delCommand = 'rm -f #INTERACTIVE "#SRCFILE"'
-            delCommand = delCommand.replace('#INTERACTIVE','-i') if prompt else delCommand.replace('#INTERACTIVE','')
-            delCommand = delCommand.replace('#SRCFILE',self.convertFilePath(category, el))
-            os.system(delCommand)
+            elements.append((category, el, curPath))
+     
+      return elements
 
-            # increase counter
+   def deleteElements(self, elements):
+      deleted = 0
+      for category, el, path in elements:
+         try:
+            os.remove(path)
             deleted += 1
-     
+         except OSError as e:
+            print "  [WARN] Element '" + path + "' couldn't be deleted (" + str(e) + ")"
+            continue
+         with self.lock:
+            self.listings.get(category, set([])).discard(el)
+      return deleted
+                     
+
+
+
+# ===================================
+# ===================================
+# Piwigo ftp-based implementation
+# (same as file-based implementation but without FTP mount)
+# ===================================
+# ===================================
+class PiwigoFTPClient(PiwigoFileClient):
+
+   # server settings
+   host = None
+   port = None
+   username = None
+   password = None
+   tls = False
+   
+   # pool of logged-in connections
+   connections = None
+   maxConnections = 1
+   openConnections = 0
+   
+   # MLSD supported by the server (LIST otherwise)
+   mlsd = True
+   
+   def __init__(self,settings):
+      self.target = settings['targetFolder'] if settings['targetFolder'] is not None else "/"
+      self.dataFolder = settings.get('dataFolder')
+      self.host = settings['host']
+      self.port = settings['port']
+      self.username = settings['username']
+      self.password = settings['password']
+      self.tls = settings['tls']
+      self.listings = {}
+      self.lock = threading.Lock()
+      self.copyPool = ThreadPool(2)
+      
+      # one connection per upload thread (+1 for the main thread and +1 for videos)
+      self.maxConnections = settings.get('connections', 1) + 2
+      self.connections = Queue.Queue()
+      
+      # check that server is reachable and target folder exists
+      if self.host is None:
+         print "  [ERROR] No FTP host specified!"
+         sys.exit(1)
+      
+      try:
+         with self.connection() as ftp:
+            ftp.cwd(self.target)
+      except ftplib.all_errors as e:
+         print "  [ERROR] Target folder '" + self.target + "' on '" + self.host + "' isn't accessible: " + str(e)
+         sys.exit(1)
+   
+   # ===================================
+   # Provides a logged-in connection from the pool
+   # (broken connections are not given back to the pool, error replies keep the connection usable)
+   # Idle connections are checked before reuse (servers close them after a timeout)
+   # ===================================
+   @contextlib.contextmanager
+   def connection(self):
+      ftp = None
+      while ftp is None:
+         try:
+            ftp = self.alive(self.connections.get(False))
+         except Queue.Empty:
+            with self.lock:
+               create = self.openConnections < self.maxConnections
+               if create:
+                  self.openConnections += 1
+            if create:
+               try:
+                  ftp = ftplib.FTP_TLS() if self.tls else ftplib.FTP()
+                  ftp.connect(self.host, self.port)
+                  ftp.login(self.username or 'anonymous', self.password or '')
+                  if self.tls:
+                     ftp.prot_p()
+               except:
+                  with self.lock:
+                     self.openConnections -= 1
+                  raise
+            else:
+               ftp = self.alive(self.connections.get())
+      
+      try:
+         yield ftp
+      except (ftplib.error_perm, ftplib.error_temp) as e:
+         # error reply (ex: folder already exists) => connection is still usable
+         # (except 421: server closes the connection)
+         if str(e).startswith('421'):
+            self.discard(ftp)
+         else:
+            self.connections.put(ftp)
+         raise
+      except:
+         # connection is probably broken => close it
+         self.discard(ftp)
+         raise
+      self.connections.put(ftp)
+   
+   # Returns given pooled connection if it still responds (discarded otherwise)
+   def alive(self, ftp):
+      try:
+         ftp.voidcmd('NOOP')
+         return ftp
+      except ftplib.all_errors:
+         self.discard(ftp)
+         return None
+   
+   def discard(self, ftp):
+      try:
+         ftp.close()
+      finally:
+         with self.lock:
+            self.openConnections -= 1
+   
+   # Lists a target category once (one request per category)
+   # Returns names with their facts (type, size)
+   def listCategory(self, category):
+      with self.lock:
+         if category in self.listings:
+            return self.listings[category]
+      
+      folder = self.convertCategoryPath(category)
+      with self.connection() as ftp:
+         try:
+            entries = self.listFolder(ftp, folder)
+         except ftplib.error_perm as e:
+            # folder doesn't exist (501 = not a directory for MLSD)
+            if not str(e)[:3] in ('550', '501'):
+               raise
+            entries = {}
+      
+      with self.lock:
+         self.listings[category] = entries
+         return entries
+   
+   # ===================================
+   # Lists a folder with MLSD (facts type and size)
+   # Falls back to LIST if MLSD isn't supported (ex: vsftpd)
+   #  - unix listings provide type and size
+   #  - other listings (ex: Windows servers) are replaced by NLST (names only, files are uploaded again)
+   # ===================================
+   def listFolder(self, ftp, folder):
+      entries = {}
+      lines = []
+      if self.mlsd:
+         try:
+            ftp.retrlines('MLSD ' + folder, lines.append)
+            for line in lines:
+               facts, name = line.split(' ', 1)
+               facts = dict([f.split('=', 1) for f in facts.lower().split(';') if '=' in f])
+               if not name in ('.', '..'):
+                  entries[name] = facts
+            return entries
+         except ftplib.error_perm as e:
+            # command not understood/implemented
+            if not str(e)[:3] in ('500', '502'):
+               raise
+            self.mlsd = False
+            lines = []
+      
+      ftp.retrlines('LIST ' + folder, lines.append)
+      for line in lines:
+         fields = line.split(None, 8)
+         if line.startswith('total '):
+            continue
+         if len(fields) < 9 or not fields[0][:1] in ('-', 'd', 'l'):
+            return dict([(os.path.basename(name), {}) for name in ftp.nlst(folder)])
+         name = fields[8].split(' -> ')[0] if fields[0].startswith('l') else fields[8]
+         if not name in ('.', '..'):
+            entries[name] = {'type': 'dir' if fields[0].startswith('d') else 'file', 'size': fields[4]}
+      return entries
+   
+   def categoryExists(self, category):
+      category = category.strip('/')
+      if category == "":
+         return True
+      parent, name = os.path.split(category)
+      return self.convertPath(name) in self.listCategory(parent)
+   
+   def addCategory(self, category):
+      category = category.strip('/')
+      try:
+         with self.connection() as ftp:
+            ftp.mkd(self.convertCategoryPath(category))
+      except ftplib.error_perm:
+         # could have been created by another thread in the meantime (listed when needed)
+         with self.lock:
+            self.listings.pop(os.path.dirname(category), None)
+         if not self.categoryExists(category):
+            raise
+         return
+      
+      parent, name = os.path.split(category)
+      with self.lock:
+         self.listings.setdefault(parent, {})[self.convertPath(name)] = {'type': 'dir'}
+         self.listings[category] = {}
+   
+   # Uploads a file into a category (temporary name, then renamed)
+   # Files already on target with same size are not uploaded again (unless replaced)
+   def copyFile(self, file, category, filename, replace = False):
+      tFile = self.convertFilePath(category, filename)
+      tName = os.path.basename(tFile)
+      size = fileSize(file)
+      facts = self.listCategory(category).get(tName)
+      if not replace and facts is not None and facts.get('size') == str(size):
+         return tFile
+      
+      tTemp = os.path.join(os.path.dirname(tFile), "." + tName + ".part")
+      with metrics.measure('copy', 'ftp'):
+         with self.connection() as ftp:
+            with openFile(file) as f:
+               ftp.storbinary('STOR ' + tTemp, f, 64 * 1024)
+            ftp.rename(tTemp, tFile)
+      metrics.add('copy', 'ftp', bytes = size)
+      
+      with self.lock:
+         self.listings.setdefault(category, {})[tName] = {'type': 'file', 'size': str(size)}
+      return tFile
+   
+   def addImage(self, file, category, filename, imageId = None):
+      try:
+         return self.copyFile(file, category, filename, imageId is not None)
+      except ftplib.all_errors as e:
+         print "  [WARN] Image '" + filename + "' couldn't be uploaded (" + str(e) + ")"
+         return None
+   
+   def addOther(self, file, representative, category, filename):
+      try:
+         return PiwigoFileClient.addOther(self, file, representative, category, filename)
+      except ftplib.all_errors as e:
+         print "  [WARN] Video '" + filename + "' couldn't be uploaded (" + str(e) + ")"
+         return None
+   
+   def addDerivatives(self, derivatives, category, filename, replace = False):
+      try:
+         PiwigoFileClient.addDerivatives(self, derivatives, category, filename, replace)
+      except ftplib.all_errors as e:
+         print "  [WARN] Derivatives of '" + filename + "' couldn't be uploaded (" + str(e) + ")"
+   
+   def deleteElements(self, elements):
+      deleted = 0
+      with self.connection() as ftp:
+         for category, el, path in elements:
+            try:
+               ftp.delete(path)
+               deleted += 1
+            except ftplib.error_perm as e:
+               print "  [WARN] Element '" + path + "' couldn't be deleted (" + str(e) + ")"
+               continue
+            with self.lock:
+               self.listings.get(category, {}).pop(el, None)
       return deleted
                      
 
 
 
+# ===================================
+# ===================================
+# Concurrency limit (AIMD) for web API requests
+#  - additive increase (+1 per limit successful requests)
+#  - multiplicative decrease (half) on errors or if a request is much slower
+#    than usual for its method (at most once per second)
+# ===================================
+# ===================================
+class AdaptiveLimit(object):
+
+   # request is considered slow if latency > tolerance x usual latency + slack (seconds)
+   # (latency per MB sent for bigger requests, uploads of big files aren't slow)
+   tolerance = 4
+   slack = 1.0
+   unit = 1024 * 1024
+
+   condition = None
+   maxLimit = None
+   limit = None
+   inFlight = 0
+   baselines = None
+   lastDecrease = 0
+
+   def __init__(self, maxLimit):
+      self.condition = threading.Condition()
+      self.maxLimit = max(1, maxLimit)
+      self.limit = float(self.maxLimit)
+      self.baselines = {}
+
+   def acquire(self):
+      with self.condition:
+         while self.inFlight >= int(self.limit):
+            self.condition.wait()
+         self.inFlight += 1
+
+   def release(self, name, latency, failed, size = 0):
+      latency = latency / max(1.0, float(size) / self.unit)
+      with self.condition:
+         self.inFlight -= 1
+         
+         # usual latency (minimum, slowly following permanent changes)
+         baseline = self.baselines.get(name)
+         self.baselines[name] = latency if baseline is None else min(latency, baseline * 1.01)
+         
+         if failed or (baseline is not None and latency > self.tolerance * baseline + self.slack):
+            if time.time() - self.lastDecrease > 1:
+               self.limit = max(1.0, self.limit / 2)
+               self.lastDecrease = time.time()
+         else:
+            self.limit = min(float(self.maxLimit), self.limit + 1.0 / self.limit)
+         self.condition.notify_all()
+
+
+
+
+# ===================================
+# ===================================
+# Multipart body (form fields and files) streamed from disk
+#  - generated while it's being sent: files (paths or file objects) are read in blocks of bufferSize (constant memory)
+#  - length is known in advance (Content-Length, no chunked transfer encoding)
+#  - progress(sent, total) is called for each block of files
+# ===================================
+# ===================================
+class MultipartStream(object):
+
+   bufferSize = 64 * 1024
+
+   boundary = None
+   contentType = None
+   progress = None
+   
+   # parts: strings or (path, size) of files
+   parts = None
+   length = 0
+   filesSize = 0
+   
+   # generated blocks, current block and position in it
+   blocks = None
+   block = ""
+   offset = 0
+
+   def __init__(self, fields, files, bufferSize = None, progress = None):
+      self.boundary = base64.b16encode(os.urandom(16)).lower()
+      self.contentType = "multipart/form-data; boundary=" + self.boundary
+      self.bufferSize = bufferSize or self.bufferSize
+      self.progress = progress
+      
+      self.parts = []
+      for name, value in sorted(fields.items()):
+         value = value.encode('utf-8') if isinstance(value, unicode) else str(value)
+         self.parts.append(self.header(name) + "\r\n\r\n" + value + "\r\n")
+      for name, (filename, path) in sorted(files.items()):
+         # (quotes and line breaks are escaped like browsers do)
+         filename = filename.replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+         self.parts.append(self.header(name) + '; filename="' + filename + '"\r\nContent-Type: application/octet-stream\r\n\r\n')
+         self.parts.append((path, fileSize(path)))
+         self.parts.append("\r\n")
+      self.parts.append("--" + self.boundary + "--\r\n")
+      
+      self.filesSize = sum([p[1] for p in self.parts if isinstance(p, tuple)])
+      self.length = sum([p[1] if isinstance(p, tuple) else len(p) for p in self.parts])
+      self.blocks = self.generate()
+
+   def header(self, name):
+      return "--" + self.boundary + '\r\nContent-Disposition: form-data; name="' + name + '"'
+
+   # ===================================
+   # Generates the body (files are opened one after the other)
+   # ===================================
+   def generate(self):
+      sent = 0
+      for part in self.parts:
+         if not isinstance(part, tuple):
+            yield part
+            continue
+         with openFile(part[0]) as f:
+            for block in iter(lambda: f.read(self.bufferSize), ''):
+               yield block
+               sent += len(block)
+               if self.progress is not None:
+                  self.progress(sent, self.filesSize)
+
+   # file-like interface (httplib sends bodies providing read() block by block)
+   def read(self, size = -1):
+      if size < 0:
+         data = self.block[self.offset:] + "".join(self.blocks)
+         self.block, self.offset = "", 0
+         return data
+      if self.offset >= len(self.block):
+         self.block, self.offset = next(self.blocks, ""), 0
+      data = self.block[self.offset:self.offset + size]
+      self.offset += len(data)
+      return data
+
+   def __len__(self):
+      return self.length
+
+   def __iter__(self):
+      return iter(lambda: self.read(self.bufferSize), "")
+
+   # closes the file being sent (body not entirely sent)
+   def close(self):
+      self.blocks.close()
+
+
+
+
 # ===================================
 # ===================================
 # Piwigo api-based implementation
@@ -205,86 +777,219 @@ class APIPiwigoClient(object):
 
    # enable traces
    traces = False
+   
+   # uploaded images can be found by checksum (pwg.images.exist)
+   checksums = True
 
    # target settings
    baseURL = None
-   cookie = None
    
-   # cache
-   cacheCategoryId = None
-   cacheCategory   = None
-   cacheImages     = None
+   # HTTP session (keep-alive connections, pwg_id cookie)
+   session = None
+   credentials = None
+   
+   # transient errors (connection, timeout, HTTP 5xx/429, invalid response) are retried
+   # after a random delay (exponential backoff: up to baseDelay x 2^attempt, max maxDelay seconds)
+   retries = 5
+   timeout = 120
+   baseDelay = 1.0
+   maxDelay = 60.0
+   
+   # concurrent requests (adaptive)
+   limit = None
+   
+   # number of checksums per pwg.images.exist request
+   existBatchSize = 500
+   
+   # number of images per pwg.images.delete request
+   deleteBatchSize = 100
+   
+   # uploads are streamed from disk (read by blocks of bufferSize)
+   # progress is printed for files bigger than progressSize
+   bufferSize = 64 * 1024
+   progressSize = 10 * 1024 * 1024
+   
+   # chunked uploads (chunkSize = 0 => single request)
+   chunkSize = 0
+   chunksInFlight = 1
+   chunkFolder = None
+   
+   # category index (path => id)
+   categories = None
+   
+   # categories images have been linked to during this run (image id => category ids)
+   linked = None
+   
+   # chunked uploads in progress (checksum => [lock, pending uploads])
+   uploading = None
+   
+   # cache of category listings (shared by upload threads)
+   # LRU: category => {image name: (image id, category ids)}, at most listingsSize categories
+   # (outdated counts invalidations, listings fetched in the meantime aren't cached)
+   lock            = None
+   listings        = None
+   listingsSize    = 100
+   outdated        = 0
          
    def __init__(self, settings):
       # settings don't have to be validated. Login would fail if they are correct.
       self.baseURL = settings['serviceURL']
-      data = {'username': settings['username'], 'password': settings['password']}
-      self.request('pwg.session.login', data)
+      self.lock = threading.RLock()
+      self.linked = {}
+      self.uploading = {}
+      self.listings = collections.OrderedDict()
+      self.listingsSize = max(1, settings.get('listingsSize', self.listingsSize))
+      
+      # acknowledged chunks are remembered in temp folder (resume after failure or restart)
+      self.chunkSize = settings.get('chunkSize', 0)
+      self.chunksInFlight = max(1, settings.get('chunksInFlight', 1))
+      if self.chunkSize > 0:
+         self.chunkFolder = os.path.join(settings['tempFolder'], 'chunks')
+         try:
+            os.mkdir(self.chunkFolder)
+         except OSError:
+            # could have been created by another shard in the meantime
+            if not os.path.isdir(self.chunkFolder):
+               raise
+      
+      # requests of all upload threads (+1 for the main thread) and their chunks share an adaptive limit
+      connections = settings.get('connections', 1) + 1
+      maxRequests = connections * (self.chunksInFlight if self.chunkSize > 0 else 1)
+      self.retries = settings.get('retries', self.retries)
+      self.timeout = settings.get('timeout', self.timeout)
+      self.limit = AdaptiveLimit(maxRequests)
+      
+      # one pooled connection per request in flight (limit never exceeds its initial value)
+      self.session = requests.Session()
+      self.session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=maxRequests))
+      self.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=maxRequests))
+      
+      self.credentials = {'username': settings['username'], 'password': settings['password']}
+      self.request('pwg.session.login', self.credentials)
+      self.loadCategories()
 
    def __del__(self):
-      self.request('pwg.session.logout', {})
+      try:
+         self.request('pwg.session.logout', {})
+      except PiwigoError:
+         pass
 
    # ===================================
    # Piwigo request to web API
+   #  - transient errors are retried (see retries)
+   #  - requests which aren't idempotent (creations, deletions) provide verify: called before sending
+   #    again if the request could have been applied, returns its result if it was (None otherwise)
+   #  - expired session (pwg_id) => login again
+   #  - files {name: (filename, path or file object)} are streamed (see MultipartStream)
+   # Raises PiwigoError
    # ===================================
-   def request(self, method, content, files = None):
+   def request(self, method, content, files = None, progress = None, verify = None):
       
       params = {'method': method, 'format': 'json'}
-      cookies = dict(pwg_id=self.cookie) if not self.cookie is None else None
-      
-      r = requests.post(self.baseURL + '/ws.php', params=params, data=content, cookies=cookies, files=files)
-      result = r.json
+      attempt = 0
+      relogged = False
       
-      # debug
-      if self.traces:
-         print r.url
+      # logout is not worth waiting for
+      retries = 0 if method == 'pwg.session.logout' else self.retries
       
-      # store cookie (1st time)
-      if self.cookie is None:
-         self.cookie = r.cookies['pwg_id']
+      with metrics.measure('request', method):
+         while True:
+            # files are sent again from the beginning
+            body = MultipartStream(content, files, self.bufferSize, progress) if files else None
+            size = len(body) if body is not None else sum([len(v) for v in content.values() if isinstance(v, basestring)])
+            
+            error = None
+            retryAfter = None
+            applied = True
+            self.limit.acquire()
+            start = time.time()
+            try:
+               # session keeps the connection alive and sends the pwg_id cookie
+               r = self.session.post(self.baseURL + '/ws.php', params=params, data=body if body is not None else content,
+                                     headers={'Content-Type': body.contentType} if body is not None else None, timeout=self.timeout)
+               metrics.add('request', method, bytes = len(r.request.body or '') + len(r.content))
+               try:
+                  # requests >= 1.0 provides json() as method
+                  result = r.json() if callable(r.json) else r.json
+               except ValueError:
+                  result = None
+               
+               # debug
+               if self.traces:
+                  print r.url
+               
+               if r.status_code >= 500 or r.status_code == 429:
+                  error = "HTTP " + str(r.status_code)
+                  retryAfter = r.headers.get('Retry-After')
+                  applied = r.status_code != 429
+               # strange: logout doesn't return any result??
+               elif result is None and not method == 'pwg.session.logout':
+                  error = "empty result"
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+               error = str(e)
+               applied = not isinstance(e, requests.exceptions.ConnectTimeout)
+            finally:
+               if body is not None:
+                  body.close()
+               self.limit.release(method, time.time() - start, error is not None, size)
+            
+            if error is None:
+               if result is None or result['stat'] == 'ok':
+                  return result['result'] if result is not None else None
+               
+               # session expired => login and send again (with new token)
+               if result.get('err') == 401 and not relogged and method != 'pwg.session.login':
+                  print "  [WARN] Session expired. Logging in again..."
+                  relogged = True
+                  self.request('pwg.session.login', self.credentials)
+                  if 'pwg_token' in content:
+                     content = dict(content, pwg_token=self.request('pwg.session.getStatus', {})['pwg_token'])
+                  continue
+               
+               raise PiwigoError("Communication error [" + str(result['err']) + "]: " + str(result.get('message')))
+            
+            attempt += 1
+            if attempt > retries:
+               raise PiwigoError("Communication error (" + error + ")")
+            
+            # random delay (exponential backoff), at least what server asked for
+            delay = random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** attempt))
+            if retryAfter is not None and retryAfter.isdigit():
+               delay = max(delay, min(self.maxDelay, int(retryAfter)))
+            print "  [WARN] Request '" + method + "' failed (" + error + "). Retrying in %.1fs..." % delay
+            metrics.add('retry', method, 1)
+            time.sleep(delay)
+            
+            # creation/deletion could have been applied by the server (ex: timeout after commit)
+            # => target is checked before sending it again
+            if verify is not None and applied:
+               result = verify()
+               if result is not None:
+                  return result
+   
+   # ===================================
+   # Loads the whole category tree (single request) into the path => id index
+   # ===================================
+   def loadCategories(self):
+      result = self.request('pwg.categories.getList', {'cat_id': 0, 'recursive': 'true'})
+      names = {}
+      for c in result['categories']:
+         names[str(c['id'])] = c['name'].encode('utf-8')
       
-      if result is None:
-         # strange: logout doesn't return any result??
-         if not method == 'pwg.session.logout':
-            print "  [ERROR] Communication error (empty result)"
-            sys.exit(1)
-      elif result['stat'] == 'ok':
-         return result['result']
-      else:
-         print "  [ERROR] Communication error [" + str(result['err']) + "]: " + result['message']
-         sys.exit(1)
+      # (index replaced at once, can be loaded again while used)
+      categories = {}
+      for c in sorted(result['categories'], key=lambda c: int(c['id'])):
+         # uppercats = ids from root to current category (ex: "1,5,7")
+         path = "/".join([names[i] for i in str(c['uppercats']).split(',')])
+         if not path in categories:
+            categories[path] = c['id']
+      self.categories = categories
    
    # ===================================
    # Retrieves categoryId from path
    # ===================================
    def getCategoryId(self, category):
-      # check cache
-      if self.cacheCategory == category:
-         return self.cacheCategoryId
-      
-      if category == "":
-         return None
-      
-      # remove first '/'
-      if category.startswith('/'):
-         category = category[1:]
-      
-      categories = category.split('/')
-      cur = 0
-      found = False
-
-      for cat in categories:
-         result = self.request('pwg.categories.getList', {'cat_id': cur})
-         for c in result['categories']:
-            # current category found
-            if c['name'].encode('utf-8') == cat:
-               cur = c['id']
-               found = True
-         
-         if not found:
-            return None
-         
-      return cur if found else None
+      return self.categories.get(category.strip('/'))
          
    
    # ===================================
@@ -292,94 +997,875 @@ class APIPiwigoClient(object):
    # ===================================
    def getParentCategoryId(self, category):
       # remove last part
-      parentCategory = category[:category.rfind('/')]
-      return getCategoryId(parentCategory)
+      category = category.strip('/')
+      parentCategory = category[:category.rfind('/')] if '/' in category else ""
+      return self.getCategoryId(parentCategory)
       
 
    def categoryExists(self, category):
-      # check cache
-      if self.cacheCategory == category:
-         return True
-      
       # root category always exists
-      if category == "":
+      if category.strip('/') == "":
          return True
-         
-      catId = self.getCategoryId(category)
-      if catId is None:
-         return False
-         
-      # update cache
-      self.cacheCategoryId = catId
-      self.cacheCategory = category
-      self.cacheImages = None
-      return True
+      return self.getCategoryId(category) is not None
       
 
    def addCategory(self, category):
-      index = category.rfind('/')
-      parentCategory = "" if index < 0 else category[:category.rfind('/')]
-      parentCategoryId = "" if index < 0 else self.getCategoryId(parentCategory)
-      currentCategory = category if index < 0 else category[category.rfind('/')+1:]
-      
-      print "Parent = " + parentCategory
-      print "Current = " + currentCategory
+      category = category.strip('/')
+      currentCategory = category[category.rfind('/')+1:]
       
       # ignore root category
       if currentCategory == "":
          return
       
-      params = {}
-      if parentCategoryId is None:
-         params = {'name': currentCategory}
-      else:
-         params = {'name': currentCategory,'parent': str(parentCategoryId)}
-      
-      # create new album
-      self.request('pwg.categories.add', params)
+      params = {'name': currentCategory}
+      parentCategoryId = self.getParentCategoryId(category)
+      if parentCategoryId is not None:
+         params['parent'] = str(parentCategoryId)
       
+      # (album could have been created by a failed attempt)
+      def created():
+         self.loadCategories()
+         categoryId = self.getCategoryId(category)
+         return {'id': categoryId} if categoryId is not None else None
       
-
-   def fileExists(self, category, filename):
+      # create new album and keep index up-to-date
+      result = self.request('pwg.categories.add', params, verify=created)
+      with self.lock:
+         self.categories[category] = result['id']
       
-      categoryId = self.getCategoryId(category) if self.categoryExists(category) else None
       
-      if categoryId is None:
-         return False
+
+   # ===================================
+   # Retrieves images of a category (name => (image id, category ids)) from cache or server
+   # ===================================
+   def listImages(self, category):
+      with self.lock:
+         categoryId = self.getCategoryId(category)
+         
+         if categoryId is None:
+            return {}
+         
+         # most recently used categories are at the end
+         images = self.listings.pop(category, None)
+         if images is not None:
+            self.listings[category] = images
+            return images
+         outdated = self.outdated
       
-      # retrieve images from cache or server
-      if self.cacheImages is None:
-         self.cacheImages = set([])
-         result = self.request('pwg.categories.getImages', {'cat_id': categoryId, 'per_page': {10000}})
-         # add all image names into cache
-         for i in result['images']['_content']:
-            self.cacheImages.add(i['name'])
+      # request (and its retries) without lock => other threads aren't blocked
+      images = {}
+      result = self.request('pwg.categories.getImages', {'cat_id': categoryId, 'per_page': {10000}})
+      # add all images into cache (older versions return images in '_content')
+      content = result['images']
+      content = content['_content'] if isinstance(content, dict) else content
+      for i in content:
+         images[i['name'].encode('utf-8')] = (i['id'], tuple([c['id'] for c in i.get('categories', [])]))
       
+      with self.lock:
+         if outdated != self.outdated:
+            return images
+         
+         # (listing fetched by another thread in the meantime is kept)
+         images = self.listings.pop(category, images)
+         self.listings[category] = images
+         while len(self.listings) > self.listingsSize:
+            self.listings.popitem(last = False)
+         return images
+   
+   def fileExists(self, category, filename):
       # check if filename is in cache (= image exists)
-      return filename in self.cacheImages
+      return filename in self.listImages(category)
+   
+   # Returns the id of the image found in the category listing
+   def fileReference(self, category, filename):
+      image = self.listImages(category).get(filename)
+      return image[0] if image is not None else None
    
+   # Returns {'image_id': id} if a new image has been added to the category (listed again), None otherwise
+   # (verifies an upload which could have been applied, see request)
+   def imageAdded(self, category, filename):
+      with self.lock:
+         self.listings.pop(category, None)
+         self.outdated += 1
+      imageId = self.fileReference(category, filename)
+      return {'image_id': imageId} if imageId is not None else None
+
+   def refresh(self):
+      with self.lock:
+         self.listings.clear()
+         self.outdated += 1
+
    
-   def addImage(self, file, category, filename):
+   def addImage(self, file, category, filename, imageId = None):
       
-      categoryId = self.getCategoryId(category) if self.categoryExists(category) else None
+      categoryId = self.getCategoryId(category)
       
       # something whe
       if categoryId is None:
          print "  [WARN] Category '" + category + "' couln't be found! Skipping image '" + filename + "'..."
          return
       
+      # new image could have been added by a failed attempt (replacing can be sent again)
+      verify = (lambda: self.imageAdded(category, filename)) if imageId is None else None
+      
+      # big files are sent in chunks
+      if self.chunkSize > 0:
+         return self.addImageChunked(file, categoryId, filename, imageId, verify)
+      
       options = {'category': categoryId, 'name': filename }
-      files = {'image': (filename, open(file, 'rb'))}
-      result = self.request('pwg.images.addSimple', options, files)
+      if imageId is not None:
+         options['image_id'] = imageId
+      result = self.request('pwg.images.addSimple', options, {'image': (filename, file)}, self.uploadProgress(filename), verify)
+      return result['image_id']
+   
+   # Prints the progress of big uploads (every 25%)
+   def uploadProgress(self, filename):
+      printed = set([])
+      def progress(sent, total):
+         step = sent * 4 // total
+         if total >= self.progressSize and 0 < step < 4 and not step in printed:
+            printed.add(step)
+            print "    Uploading '" + filename + "' (" + str(step * 25) + "% of " + formatSize(total) + ")..."
+      return progress
+   
+   
+   # ===================================
+   # Serializes chunked uploads of identical files
+   # (lock is dropped once no upload of that file is pending)
+   # ===================================
+   @contextlib.contextmanager
+   def uploadLock(self, originalSum):
+      with self.lock:
+         upload = self.uploading.setdefault(originalSum, [threading.Lock(), 0])
+         upload[1] += 1
+      try:
+         with upload[0]:
+            yield
+      finally:
+         with self.lock:
+            upload[1] -= 1
+            if upload[1] == 0:
+               del self.uploading[originalSum]
+   
+   # ===================================
+   # Uploads an image in chunks (pwg.images.addChunk) and adds it (pwg.images.add)
+   #  - several chunks are sent in parallel
+   #  - chunks already acknowledged (previous attempt) are not sent again
+   # ===================================
+   def addImageChunked(self, file, categoryId, filename, imageId = None, verify = None):
+      
+      # checksum identifies the upload on the server
+      originalSum = checksum(file)
+      
+      # identical files are uploaded one after the other (same chunks and state file)
+      with self.uploadLock(originalSum):
+         # chunks still to be sent
+         stateFile = os.path.join(self.chunkFolder, originalSum)
+         done = set([])
+         if os.path.exists(stateFile):
+            with open(stateFile) as f:
+               done = set([int(l) for l in f if l.strip()])
+         count = max(1, (fileSize(file) + self.chunkSize - 1) // self.chunkSize)
+         positions = [p for p in range(count) if not p in done]
+      
+         lock = threading.Lock()
+         errors = []
+      
+         # (file is shared by all threads)
+         def sendChunks(f):
+            while True:
+               with lock:
+                  if not positions or errors:
+                     return
+                  position = positions.pop(0)
+                  f.seek(position * self.chunkSize)
+                  data = f.read(self.chunkSize)
+            
+               try:
+                  self.request('pwg.images.addChunk', {'data': base64.b64encode(data), 'original_sum': originalSum, 'type': 'file', 'position': str(position)})
+               except BaseException as e:
+                  errors.append(e)
+                  return
+            
+               # remember acknowledged chunk
+               with lock:
+                  with open(stateFile, 'a') as acks:
+                     acks.write(str(position) + "\n")
+      
+         with openFile(file) as f:
+            threads = [threading.Thread(target=sendChunks, args=(f,)) for i in range(min(self.chunksInFlight, len(positions)))]
+            for t in threads:
+               t.start()
+            for t in threads:
+               t.join()
+         if errors:
+            raise errors[0]
+      
+         # merge chunks into new image
+         options = {'original_sum': originalSum, 'original_filename': filename, 'name': filename, 'categories': str(categoryId)}
+         if imageId is not None:
+            options['image_id'] = imageId
+         # (a failed merge may have consumed the chunks on the server => all chunks are sent again next time)
+         try:
+            result = self.request('pwg.images.add', options, verify=verify)
+         finally:
+            if os.path.exists(stateFile):
+               os.remove(stateFile)
+         return result['image_id']
+
+
+   def addOther(self, file, representative, category, filename, ):
+      print "  [WARN] Videos are not yet supported by API implementation. Skipping '" + filename + "'..."
+   
+   # ===================================
+   # Checks which checksums exist on the server (in batches)
+   # Returns a dictionary checksum => image id
+   # ===================================
+   def imagesExist(self, checksums):
+      existing = {}
+      for i in range(0, len(checksums), self.existBatchSize):
+         result = self.request('pwg.images.exist', {'md5sum_list': ",".join(checksums[i:i+self.existBatchSize])})
+         for md5, imageId in result.items():
+            if imageId is not None:
+               existing[md5] = imageId
+      return existing
+   
+   # ===================================
+   # Adds an existing image to a category (moved images)
+   # ===================================
+   def linkImage(self, imageId, category):
+      categoryId = str(self.getCategoryId(category))
+      params = {'image_id': imageId, 'categories': categoryId, 'multiple_value_mode': 'append'}
+      self.request('pwg.images.setInfo', params)
+      
+      # cached listings don't know this category yet (see deleteElements)
+      with self.lock:
+         self.linked.setdefault(str(imageId), set([])).add(categoryId)
+   
+   def cleanCategory(self, category, fileList):
+      elements = []
+      for name, image in sorted(self.listImages(category).items()):
+         if not name in fileList:
+            elements.append((category, name, image))
+      return elements
+   
+   # ===================================
+   # Deletes images (in batches)
+   # Images also belonging to other categories are only removed from the category
+   # ===================================
+   def deleteElements(self, elements):
+      deleted = 0
+      ids = []
+      removed = {}
+      for category, name, (imageId, imageCategories) in elements:
+         categoryId = str(self.getCategoryId(category))
+         categories = set([str(c) for c in imageCategories]) | self.linked.get(str(imageId), set([]))
+         
+         # same image removed from several categories (listings don't know it)
+         removed.setdefault(str(imageId), set([])).add(categoryId)
+         others = sorted(categories - removed[str(imageId)])
+         if others:
+            self.request('pwg.images.setInfo', {'image_id': imageId, 'categories': ";".join(others), 'multiple_value_mode': 'replace'})
+            deleted += 1
+         else:
+            ids.append(str(imageId))
+      
+      if ids:
+         token = self.request('pwg.session.getStatus', {})['pwg_token']
+         for i in range(0, len(ids), self.deleteBatchSize):
+            batch = ids[i:i+self.deleteBatchSize]
+            self.request('pwg.images.delete', {'image_id': ",".join(batch), 'pwg_token': token},
+                         verify=lambda batch=batch: self.imagesDeleted(batch, elements))
+            deleted += len(batch)
+      
+      # cached listings are outdated
+      with self.lock:
+         for category in set([e[0] for e in elements]):
+            self.listings.pop(category, None)
+         self.outdated += 1
+      return deleted
+   
+   # Returns True if none of the images is listed anymore in the categories of the elements, None otherwise
+   # (verifies a deletion which could have been applied, see request)
+   def imagesDeleted(self, ids, elements):
+      with self.lock:
+         for category in set([e[0] for e in elements]):
+            self.listings.pop(category, None)
+         self.outdated += 1
+      for category in set([e[0] for e in elements]):
+         if any([str(image[0]) in ids for image in self.listImages(category).values()]):
+            return None
+      return True
+
+
+
+
+# ===================================
+# ===================================
+# Local sync state (SQLite index)
+# ===================================
+# ===================================
+class SyncState(object):
+
+   # number of updates before committing to disk
+   commitInterval = 500
+
+   # database (shared by upload threads)
+   db = None
+   lock = None
+   pending = 0
+
+   def __init__(self, path, settings, shared = False):
+      self.settings = settings
+      self.lock = threading.Lock()
+      self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+      self.db.text_factory = str
+      
+      # several processes (shards) => short transactions, readers don't block writers
+      if shared:
+         self.db.execute('PRAGMA journal_mode=WAL')
+         self.db.execute('PRAGMA synchronous=NORMAL')
+         self.commitInterval = 1
+      
+      # files and folders are stored per settings (several targets can share the temp folder)
+      # (single transaction, shards could open the index at the same time)
+      self.db.isolation_level = None
+      self.db.execute('BEGIN IMMEDIATE')
+      self.db.execute('CREATE TABLE IF NOT EXISTS files (settings TEXT, path TEXT, size INTEGER, mtime REAL, remote TEXT, md5 TEXT, remoteSum TEXT, PRIMARY KEY (settings, path))')
+      self.db.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, md5 TEXT)')
+      self.db.execute('CREATE TABLE IF NOT EXISTS folders (settings TEXT, path TEXT, cleaned INTEGER, entries TEXT, mtime REAL, subfolders TEXT, PRIMARY KEY (settings, path))')
+      
+      # upgrade index created by previous version (one row per path)
+      columns = [c[1] for c in self.db.execute('PRAGMA table_info(files)')]
+      for column in ('md5', 'remoteSum'):
+         if not column in columns:
+            self.db.execute('ALTER TABLE files ADD COLUMN ' + column + ' TEXT')
+      if [c[1] for c in self.db.execute('PRAGMA table_info(files)') if c[5]] == ['path']:
+         self.db.execute('ALTER TABLE files RENAME TO files_old')
+         self.db.execute('CREATE TABLE files (settings TEXT, path TEXT, size INTEGER, mtime REAL, remote TEXT, md5 TEXT, remoteSum TEXT, PRIMARY KEY (settings, path))')
+         self.db.execute('INSERT INTO files SELECT settings, path, size, mtime, remote, md5, remoteSum FROM files_old')
+         self.db.execute('DROP TABLE files_old')
+      if [c[1] for c in self.db.execute('PRAGMA table_info(folders)') if c[5]] == ['path']:
+         self.db.execute('DROP TABLE folders')
+         self.db.execute('CREATE TABLE folders (settings TEXT, path TEXT, cleaned INTEGER, entries TEXT, mtime REAL, subfolders TEXT, PRIMARY KEY (settings, path))')
+      columns = [c[1] for c in self.db.execute('PRAGMA table_info(folders)')]
+      for column, type in (('mtime', 'REAL'), ('subfolders', 'TEXT')):
+         if not column in columns:
+            self.db.execute('ALTER TABLE folders ADD COLUMN ' + column + ' ' + type)
+      self.db.execute('CREATE INDEX IF NOT EXISTS files_md5 ON files (settings, md5)')
+      self.db.execute('CREATE INDEX IF NOT EXISTS files_size ON files (settings, size)')
+      self.db.execute('COMMIT')
+      self.db.isolation_level = ''
+
+   # ===================================
+   # Returns True if file has already been synchronized with same
+   # size, modification time and settings (no need to check target)
+   # ===================================
+   def isSynchronized(self, path, stat):
+      with self.lock:
+         row = self.db.execute('SELECT size, mtime FROM files WHERE settings = ? AND path = ?', (self.settings, path)).fetchone()
+      if row is None:
+         return False
+      return row[0] == stat.st_size and row[1] == stat.st_mtime
+
+   # ===================================
+   # Stores file as synchronized
+   #  - remote: reference on target (None if unknown, previous one is never reused)
+   #  - remoteSum: checksum of uploaded file (kept if not provided for same remote reference)
+   #  - md5: content checksum (kept if not provided)
+   # ===================================
+   def update(self, path, stat, remote = None, md5 = None, remoteSum = None):
+      remote = None if remote is None else str(remote)
+      with self.lock:
+         row = self.db.execute('SELECT remote, md5, remoteSum FROM files WHERE settings = ? AND path = ?', (self.settings, path)).fetchone()
+         if row is not None and remoteSum is None and remote is not None and remote == row[0]:
+            remoteSum = row[2]
+         if row is not None and md5 is None:
+            md5 = row[1]
+         self.db.execute('INSERT OR REPLACE INTO files (settings, path, size, mtime, remote, md5, remoteSum) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (self.settings, path, stat.st_size, stat.st_mtime, remote, md5, remoteSum))
+         self.modified()
+   
+   # ===================================
+   # Returns (md5, remote, remoteSum) of last synchronization
+   # ===================================
+   def get(self, path):
+      with self.lock:
+         return self.db.execute('SELECT md5, remote, remoteSum FROM files WHERE settings = ? AND path = ?', (self.settings, path)).fetchone()
+   
+   # ===================================
+   # Returns all synchronized files with given content [(path, remote, remoteSum)]
+   # ===================================
+   def find(self, md5):
+      with self.lock:
+         return self.db.execute('SELECT path, remote, remoteSum FROM files WHERE settings = ? AND md5 = ?', (self.settings, md5)).fetchall()
+   
+   # ===================================
+   # Returns True if a synchronized file has given size (same content possible)
+   # ===================================
+   def hasSize(self, size):
+      with self.lock:
+         return self.db.execute('SELECT 1 FROM files WHERE settings = ? AND size = ? LIMIT 1', (self.settings, size)).fetchone() is not None
+   
+   # ===================================
+   # Returns the checksum of a file
+   # (computed only once for a given path, size and modification time, unless not stored)
+   # ===================================
+   def checksum(self, path, stat, store = True):
+      with self.lock:
+         row = self.db.execute('SELECT size, mtime, md5 FROM hashes WHERE path = ?', (path,)).fetchone()
+      if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+         return row[2]
+      
+      md5 = checksum(path)
+      if not store:
+         return md5
+      with self.lock:
+         self.db.execute('INSERT OR REPLACE INTO hashes (path, size, mtime, md5) VALUES (?, ?, ?, ?)', (path, stat.st_size, stat.st_mtime, md5))
+         self.modified()
+      return md5
+   
+   # ===================================
+   # Returns (entries digest, cleaned) of a folder
+   # completely synchronized with same settings
+   # ===================================
+   def getFolder(self, path):
+      with self.lock:
+         row = self.db.execute('SELECT cleaned, entries FROM folders WHERE settings = ? AND path = ?', (self.settings, path)).fetchone()
+      if row is None:
+         return None
+      return row[1], bool(row[0])
+   
+   # ===================================
+   # Returns (modification time, subfolder names, cleaned) of a folder
+   # completely synchronized with same settings
+   # ===================================
+   def getTree(self, path):
+      with self.lock:
+         row = self.db.execute('SELECT mtime, subfolders, cleaned FROM folders WHERE settings = ? AND path = ?', (self.settings, path)).fetchone()
+      if row is None or row[0] is None:
+         return None
+      return row[0], row[1].split('/') if row[1] else [], bool(row[2])
+   
+   # ===================================
+   # Stores folder as completely synchronized
+   #  - entries: digest of file names, sizes and modification times
+   #  - cleaned: elements without match in source folder have been deleted
+   #  - mtime, subfolders: folder modification time and subfolder names (see updateTree)
+   # ===================================
+   def updateFolder(self, path, entries, cleaned, mtime = None, subfolders = None):
+      with self.lock:
+         self.db.execute('INSERT OR REPLACE INTO folders (settings, path, cleaned, entries, mtime, subfolders) VALUES (?, ?, ?, ?, ?, ?)',
+            (self.settings, path, 1 if cleaned else 0, entries, mtime, None if subfolders is None else "/".join(subfolders)))
+         self.modified()
+   
+   # ===================================
+   # Updates modification time and subfolder names of a synchronized folder
+   # (folder listed again with same files, ex: subfolder added)
+   # ===================================
+   def updateTree(self, path, mtime, subfolders):
+      with self.lock:
+         self.db.execute('UPDATE folders SET mtime = ?, subfolders = ? WHERE settings = ? AND path = ?',
+            (mtime, "/".join(subfolders), self.settings, path))
+         self.modified()
+   
+   def modified(self):
+      self.pending += 1
+      if self.pending >= self.commitInterval:
+         self.db.commit()
+         self.pending = 0
+
+   def commit(self):
+      with self.lock:
+         self.db.commit()
+         self.pending = 0
+
+   def close(self):
+      self.commit()
+      self.db.close()
+
+
+
+
+# ===================================
+# ===================================
+# Cache of converted images/videos (content-addressed, LRU)
+# ===================================
+# ===================================
+class DerivativeCache(object):
+
+   # cache folder and size limit (bytes)
+   folder = None
+   maxSize = 0
+   size = 0
+   lock = None
+
+   def __init__(self, folder, maxSize):
+      self.folder = folder
+      self.maxSize = maxSize
+      self.lock = threading.Lock()
+      try:
+         os.mkdir(self.folder)
+      except OSError:
+         # could have been created by another shard in the meantime
+         if not os.path.isdir(self.folder):
+            raise
+      
+      # current size
+      for el in os.listdir(self.folder):
+         self.size += os.path.getsize(os.path.join(self.folder, el))
+
+   # ===================================
+   # Builds the cache key from conversion parameters
+   # (source checksum, settings, tool version)
+   # ===================================
+   def key(self, *params):
+      return hashlib.sha1("|".join([str(p) for p in params])).hexdigest()
+
+   # ===================================
+   # Copies cached files into given destinations
+   # Returns False if any of them is missing
+   # ===================================
+   def get(self, key, destFiles):
+      with self.lock:
+         entries = [os.path.join(self.folder, key + "." + str(i)) for i in range(len(destFiles))]
+         if not all([os.path.exists(e) for e in entries]):
+            metrics.add('cache', 'miss', 1)
+            return False
+         metrics.add('cache', 'hit', 1)
+         try:
+            for entry, dest in zip(entries, destFiles):
+               # last access (LRU)
+               os.utime(entry, None)
+               linkOrCopy(entry, dest)
+         except (IOError, OSError):
+            # evicted by another process (shards)
+            return False
+         return True
+
+   # ===================================
+   # Stores files (paths or file objects) into the cache (evicts least recently used entries if full)
+   # ===================================
+   def put(self, key, srcFiles):
+      with self.lock:
+         for i, src in enumerate(srcFiles):
+            entry = os.path.join(self.folder, key + "." + str(i))
+            if os.path.exists(entry):
+               self.size -= os.path.getsize(entry)
+               os.remove(entry)
+            if isinstance(src, basestring):
+               linkOrCopy(src, entry)
+            else:
+               with openFile(src) as f, open(entry, 'wb') as dest:
+                  shutil.copyfileobj(f, dest, 1024 * 1024)
+            self.size += os.path.getsize(entry)
+         
+         if self.size > self.maxSize:
+            self.evict()
+
+   def evict(self):
+      # remove oldest entries until cache is filled up to 90%
+      entries = [os.path.join(self.folder, el) for el in os.listdir(self.folder)]
+      entries = sorted([(os.path.getmtime(e), os.path.getsize(e), e) for e in entries])
+      for mtime, size, entry in entries:
+         if self.size <= self.maxSize * 0.9:
+            break
+         os.remove(entry)
+         self.size -= size
+
+
+
+
+# ===================================
+# ===================================
+# Metadata of images and videos (single exiftool process, -stay_open mode)
+# Commands are sent through stdin, each output ends with {ready}
+# ===================================
+# ===================================
+class ExifTool(object):
+
+   # files per read command
+   batchSize = 500
+
+   process = None
+   available = True
+   lock = None
+
+   def __init__(self):
+      self.lock = threading.RLock()
+
+   # ===================================
+   # Starts exiftool on first use
+   # Returns False if exiftool isn't installed
+   # ===================================
+   def start(self):
+      with self.lock:
+         if self.process is None and self.available:
+            try:
+               with open(os.devnull, 'w') as devnull:
+                  self.process = subprocess.Popen(['exiftool', '-stay_open', 'True', '-@', '-'],
+                                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=devnull)
+            except OSError:
+               print "  [WARN] exiftool is not installed. Dates are extracted from filenames (format _YYYYMMDD_HHMMSS)."
+               self.available = False
+         return self.available
+
+   # ===================================
+   # Executes commands (lists of arguments) one after the other
+   # (output of a command is read before the next one is sent, exiftool would block on a full pipe)
+   # Returns the output of each command (None if exiftool isn't available)
+   # ===================================
+   def execute(self, commands):
+      with self.lock:
+         if not self.start():
+            return None
+         try:
+            outputs = []
+            for args in commands:
+               self.process.stdin.write("\n".join(args) + "\n-execute\n")
+               self.process.stdin.flush()
+               
+               lines = []
+               for line in iter(self.process.stdout.readline, ''):
+                  if line.rstrip() == "{ready}":
+                     break
+                  lines.append(line)
+               else:
+                  raise IOError("exiftool stopped unexpectedly")
+               outputs.append("".join(lines))
+            return outputs
+         except (IOError, OSError) as e:
+            # not started again (metadata is optional)
+            print "  [WARN] exiftool failed (" + str(e) + "). Metadata is not read/written anymore."
+            self.process = None
+            self.available = False
+            return None
+
+   # ===================================
+   # Reads capture date of files (in batches)
+   # Returns {path: {'date': 'YYYY:MM:DD HH:MM:SS' or None}}
+   # ===================================
+   def read(self, paths):
+      metadata = {}
+      batches = [paths[i:i + self.batchSize] for i in range(0, len(paths), self.batchSize)]
+      if not batches or not self.start():
+         return metadata
+      
+      with metrics.measure('metadata', 'read'):
+         # (QuickTime dates are stored in UTC)
+         outputs = self.execute([['-j', '-n', '-fast', '-api', 'QuickTimeUTC', '-DateTimeOriginal', '-CreateDate'] + batch for batch in batches])
+      for output in outputs or []:
+         try:
+            entries = json.loads(output) if output.strip() else []
+         except ValueError:
+            continue
+         for entry in entries:
+            date = None
+            for tag in ('DateTimeOriginal', 'CreateDate'):
+               value = str(entry.get(tag, ""))
+               if date is None and re.match('^[0-9]{4}:[0-9]{2}:[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}', value) and not value.startswith("0000"):
+                  date = value[:19]
+            metadata[entry['SourceFile'].encode('utf-8')] = {'date': date}
+      return metadata
+
+   # ===================================
+   # Writes tags into files [(path, {tag: value})]
+   # ===================================
+   def write(self, tags):
+      if not tags or not self.start():
+         return
+      with metrics.measure('metadata', 'write'):
+         self.execute([['-overwrite_original'] + ['-' + tag + '=' + value for tag, value in sorted(values.items())] + [path] for path, values in tags])
+
+   def close(self):
+      with self.lock:
+         if self.process is not None:
+            try:
+               self.process.stdin.write("-stay_open\nFalse\n")
+               self.process.stdin.close()
+               self.process.wait()
+            except (IOError, OSError):
+               pass
+            self.process = None
+
+
+
+
+# ===================================
+# Directory entry (same interface as scandir entries)
+# Used when scandir is not available
+# ===================================
+class DirEntry(object):
+
+   def __init__(self, folder, name):
+      self.name = name
+      self.path = os.path.join(folder, name)
+      self._stat = None
+
+   def stat(self):
+      if self._stat is None:
+         self._stat = os.stat(self.path)
+      return self._stat
+
+   def is_file(self):
+      return os.path.isfile(self.path)
+
+   def is_dir(self):
+      return os.path.isdir(self.path)
+
+
+
+
+# ===================================
+# ===================================
+# Synchronization plan (built by walking the source folder, executed afterwards)
+# Actions (dictionaries, in walk order):
+#  - category: category to create
+#  - record:   file already on target (only stored in sync state)
+#  - link:     image already uploaded from another folder (moved)
+#  - image:    image to convert and upload
+#  - video:    video to transcode and upload
+#  - delete:   element without match in source folder
+# ===================================
+# ===================================
+class SyncPlan(object):
+
+   # actions, descriptions and order of execution
+   ACTIONS = [('category', 'categories to create'), ('record', 'files already on target'), ('link', 'moved images to link'),
+              ('video', 'videos to transcode'), ('image', 'images to convert'), ('delete', 'elements to delete')]
+
+   entries = None
+
+   def __init__(self):
+      self.entries = []
+
+   def add(self, action, **values):
+      values['action'] = action
+      self.entries.append(values)
+      return values
+
+   def actions(self, action):
+      return [e for e in self.entries if e['action'] == action]
+
+   # ===================================
+   # Returns {action: (count, source bytes)}
+   # ===================================
+   def summary(self):
+      summary = {}
+      for action, description in self.ACTIONS:
+         entries = self.actions(action)
+         summary[action] = (len(entries), sum([e.get('size', 0) for e in entries]))
+      return summary
+
+   def printSummary(self):
+      summary = self.summary()
+      print ""
+      print "  Plan:"
+      for action, description in self.ACTIONS:
+         count, size = summary[action]
+         print "    " + str(count).rjust(7) + " " + description + (" (" + formatSize(size) + ")" if size > 0 else "")
+
+   # ===================================
+   # Writes the plan as JSON (file stats are left out)
+   # ===================================
+   def dump(self, path):
+      summary = dict([(action, {'count': c, 'bytes': b}) for action, (c, b) in self.summary().items()])
+      actions = [dict([(k, v) for k, v in e.items() if k != 'stat']) for e in self.entries]
+      with open(path, 'w') as f:
+         json.dump({'summary': summary, 'actions': actions}, f, indent=2, default=str)
+
+
+
+
+# ===================================
+# ===================================
+# Metrics (durations, bytes and errors per stage)
+# Written at the end of a run as JSON and Prometheus textfile
+# ===================================
+# ===================================
+class Metrics(object):
 
+   lock = None
+   start = None
+   stages = None
 
-   def addOther(self, file, representative, category, filename, ):
-      print "  [WARN] Videos are not yet supported by API implementation. Skipping '" + filename + "'..."
-   
-   def cleanCategory(self, category, fileList):
-      return 0
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.reset()
+
+   def reset(self):
+      with self.lock:
+         self.start = time.time()
+         self.stages = {}
+
+   # ===================================
+   # Adds values to a stage (name: method, tool, etc.)
+   # ===================================
+   def add(self, stage, name = "", count = 0, seconds = 0, bytes = 0, errors = 0):
+      with self.lock:
+         values = self.stages.setdefault((stage, name), {'count': 0, 'seconds': 0.0, 'bytes': 0, 'errors': 0})
+         values['count'] += count
+         values['seconds'] += seconds
+         values['bytes'] += bytes
+         values['errors'] += errors
 
+   # ===================================
+   # Measures the duration of a block (exceptions are counted as errors)
+   # ===================================
+   @contextlib.contextmanager
+   def measure(self, stage, name = ""):
+      start = time.time()
+      try:
+         yield
+      except BaseException:
+         self.add(stage, name, 1, time.time() - start, errors = 1)
+         raise
+      self.add(stage, name, 1, time.time() - start)
+
+   def toDict(self):
+      with self.lock:
+         stages = [dict(values, stage=stage, name=name) for (stage, name), values in sorted(self.stages.items())]
+      return {'start': self.start, 'duration': time.time() - self.start, 'stages': stages}
+
+   # Adds stages of another run (see toDict)
+   def merge(self, data):
+      for s in data['stages']:
+         self.add(s['stage'], s['name'], s['count'], s['seconds'], s['bytes'], s['errors'])
 
+   # ===================================
+   # Writes metrics into given folder (SCRIPTNAME.json and SCRIPTNAME.prom)
+   # Files are renamed once written (no partial file for the node exporter)
+   # Shards write SCRIPTNAME-shard-N.* (with a shard label)
+   # ===================================
+   def write(self, folder, shard = None):
+      data = self.toDict()
+      name = SCRIPTNAME if shard is None else SCRIPTNAME + "-shard-" + str(shard)
+      label = "" if shard is None else ',shard="' + str(shard) + '"'
+
+      lines = []
+      for metric, field, help in [("stage_calls_total", "count", "Number of calls per stage"),
+                                  ("stage_seconds_total", "seconds", "Time spent per stage"),
+                                  ("stage_bytes_total", "bytes", "Bytes processed per stage"),
+                                  ("stage_errors_total", "errors", "Number of errors per stage")]:
+         lines.append("# HELP " + SCRIPTNAME + "_" + metric + " " + help)
+         lines.append("# TYPE " + SCRIPTNAME + "_" + metric + " counter")
+         for s in data['stages']:
+            lines.append(SCRIPTNAME + "_" + metric + '{stage="' + s['stage'] + '",name="' + s['name'] + '"' + label + '} ' + repr(s[field]))
+      lines.append("# HELP " + SCRIPTNAME + "_run_seconds Duration of the last run")
+      lines.append("# TYPE " + SCRIPTNAME + "_run_seconds gauge")
+      lines.append(SCRIPTNAME + "_run_seconds" + ("{" + label[1:] + "}" if label else "") + " " + repr(data['duration']))
+      lines.append("# HELP " + SCRIPTNAME + "_run_timestamp_seconds Start of the last run")
+      lines.append("# TYPE " + SCRIPTNAME + "_run_timestamp_seconds gauge")
+      lines.append(SCRIPTNAME + "_run_timestamp_seconds" + ("{" + label[1:] + "}" if label else "") + " " + repr(data['start']))
+
+      for ext, content in (('.json', json.dumps(data, indent=2)), ('.prom', "\n".join(lines) + "\n")):
+         path = os.path.join(folder, name + ext)
+         with open(path + ".tmp", 'w') as f:
+            f.write(content)
+         os.rename(path + ".tmp", path)
+
+# metrics of the current run (shared by clients and main class)
+metrics = Metrics()
 
 
 
@@ -401,28 +1887,108 @@ class Folder2Piwigo(object):
    
    imageResize = None
    imageQuality = None
+   imageEngine = None
+   
+   # Piwigo derivatives generated along with images [(type, width, height)]
+   derivatives = None
+   
+   # converted images are kept in memory up to given size (bytes), 0 = written into temp folder
+   imageBuffer = 0
    
    videoQuality = None
+   videoEncoder = None
+   videoThreads = None
    
    client = None
+   state = None
+   cache = None
+   fullCheck = None
+   
+   # unchanged folders (same modification time) aren't listed again
+   pruneFolders = None
+   
+   # conversion pool
+   jobs = None
+   pool = None
+   
+   # upload threads (fed by conversion pool through a bounded queue)
+   uploads = None
+   uploadQueue = None
+   uploadThreads = None
+   uploadFailure = None
+   
+   # versions of conversion tools
+   toolVersions = None
+   
+   # metadata of source files (exiftool process shared by all threads)
+   metadata = None
+   
+   # plan of last synchronization is written into given file (JSON)
+   planFile = None
+   
+   # shard (index, count) => only albums of the source folder with hash % count == index
+   shard = None
+   
+   # folder where metrics are written at the end of the run
+   metricsFolder = None
+   
+   # watch mode (changed folders => recursive, synchronized after watchDelay seconds without changes)
+   watch = None
+   watchDelay = None
+   watchFolders = None
+   
+   # folders walked during the run (folder, files, subfolders, modification time)
+   walked = None
+   
+   # video pool (transcoding and upload, separate from images)
+   videoWorkers = None
+   videoPool = None
    
    
    # ===================================
    # Default constructor
    # ===================================
-   def __init__(self,implementation,implSettings,sourceFolder,tempFolder,simulate,delete,resize,imageQuality,videoQuality):
+   def __init__(self,implementation,implSettings,sourceFolder,tempFolder,simulate,delete,resize,imageQuality,videoQuality,syncState=True,fullCheck=False,jobs=1,uploads=1,imageEngine='convert',videoEncoder='ffmpeg2theora',videoWorkers=1,videoThreads=1,cacheSize=0,metricsFolder=None,watch=False,watchDelay=5,planFile=None,shard=None,derivatives=None,imageBuffer=0,pruneFolders=False):
       
+      metrics.reset()
       self.client = None
+      self.state = None
+      self.jobs = max(1, jobs)
+      self.pool = ThreadPool(self.jobs)
+      self.uploads = max(1, uploads)
+      self.uploadQueue = Queue.Queue(2 * self.jobs)
+      self.uploadThreads = []
+      self.uploadFailure = None
+      implSettings['connections'] = self.uploads
+      self.videoEncoder = videoEncoder
+      self.videoThreads = max(1, videoThreads)
+      self.videoWorkers = max(1, videoWorkers)
+      self.videoPool = ThreadPool(self.videoWorkers)
+      self.toolVersions = {}
+      self.metadata = ExifTool()
+      self.walked = []
       self.sourceFolder = sourceFolder
       self.tempFolder = tempFolder
       self.simulate = simulate
       self.delete = delete
-      self.resize = resize
+      self.imageResize = resize
       self.imageQuality = imageQuality
+      self.imageEngine = imageEngine
+      self.derivatives = []
+      self.imageBuffer = imageBuffer * 1024 * 1024
       self.videoQuality = videoQuality
+      self.fullCheck = fullCheck
+      self.pruneFolders = pruneFolders
+      self.metricsFolder = metricsFolder
+      self.planFile = planFile
+      self.shard = shard
+      self.watch = watch
+      self.watchDelay = watchDelay
       
       if implementation == 'file':
          self.client = PiwigoFileClient(implSettings)
+      elif implementation == 'ftp':
+         self.client = PiwigoFTPClient(implSettings)
       elif implementation == 'api':
          self.client = APIPiwigoClient(implSettings)
       else:
@@ -447,133 +2013,797 @@ class Folder2Piwigo(object):
          print "  [ERROR] Temp folder '" + self.tempFolder + "' doesn't exist!"
          sys.exit(1)
       
+      # shards only synchronize their albums (changes would be watched by all shards)
+      if self.shard is not None and self.watch:
+         print "  [ERROR] Watch mode can't be used with shards!"
+         sys.exit(1)
+      
+      # watch mode requires pyinotify
+      if self.watch and pyinotify is None:
+         print "  [ERROR] Watch mode requires pyinotify (pip install pyinotify)!"
+         sys.exit(1)
+      
+      # in-process engine requires PIL
+      if self.imageEngine == 'pil' and (Image is None or not hasattr(Image.Image, 'getexif')):
+         print "  [WARN] PIL (Pillow >= 6.0) is not installed. Using 'convert' for images."
+         self.imageEngine = 'convert'
+      
+      # derivatives: type or type:WxH (ex: th,me,la:1024x768)
+      for d in (derivatives or "").split(','):
+         match = re.match('^(' + '|'.join(DERIVATIVE_SIZES.keys()) + ')(?::([0-9]+)x([0-9]+))?$', d.strip())
+         if match is None:
+            if d.strip() != "":
+               print "  [ERROR] Invalid derivative '" + d.strip() + "' (expected " + ", ".join(sorted(DERIVATIVE_SIZES.keys())) + " with optional size WxH)!"
+               sys.exit(1)
+            continue
+         size = (int(match.group(2)), int(match.group(3))) if match.group(2) else DERIVATIVE_SIZES[match.group(1)]
+         self.derivatives.append((match.group(1), size[0], size[1]))
+      
+      # derivatives can't be uploaded through the web API (Piwigo generates them)
+      if self.derivatives and implementation == 'api':
+         print "  [WARN] Derivatives can't be uploaded with the web API (generated by Piwigo)."
+         self.derivatives = []
+      
+      # derivatives are only copied when the data folder is known (not derived from target folder)
+      if self.derivatives and implSettings.get('dataFolder') is None:
+         print "  [WARN] Derivatives can't be copied without data folder (DataFolder = PWG_HOME/_data)."
+         self.derivatives = []
+      
+      # open local sync state (settings identify target and conversion options)
+      # (simulation reads it to plan exactly what a real run would do)
+      if syncState:
+         target = implSettings['serviceURL'] if implementation == 'api' else implSettings['targetFolder']
+         target = "ftp://" + str(implSettings['host']) + target if implementation == 'ftp' else target
+         settings = "|".join([implementation, str(target), str(self.imageResize), str(self.imageQuality), str(self.videoQuality)])
+         # (images are synchronized again once derivatives are enabled or changed)
+         settings += "|" + ",".join(["%s:%dx%d" % d for d in self.derivatives]) if self.derivatives else ""
+         self.state = SyncState(os.path.join(self.tempFolder, SCRIPTNAME + ".db"), settings, self.shard is not None)
+      
+      # cache of converted files (size in MB)
+      if cacheSize > 0 and not self.simulate:
+         self.cache = DerivativeCache(os.path.join(self.tempFolder, 'cache'), cacheSize * 1024 * 1024)
       
    
    # ===================================
    # Executes the process
    # ===================================
    def run(self):
-      self.process(self.sourceFolder)
+      # CTRL+C signal
+      signal.signal(signal.SIGINT, quit_gracefully)
+      
+      try:
+         self.sync(self.walk(self.sourceFolder))
+         
+         # then synchronize changes only (until CTRL+C)
+         if self.watch:
+            self.fullCheck = False
+            self.watchChanges()
+      finally:
+         self.pool.terminate()
+         self.videoPool.terminate()
+         self.metadata.close()
+         if self.state is not None:
+            self.state.close()
+         if self.metricsFolder is not None:
+            metrics.write(self.metricsFolder, self.shard[0] + 1 if self.shard is not None else None)
    
    # ===================================
-   # Processes on folder and its subfolders (by recursion)
+   # Synchronizes given folders (see walk) and waits until all files are uploaded
    # ===================================
-   def process(self, curFolder):
+   def sync(self, folders):
+      plan = SyncPlan()
+      for curFolder, category, files in folders:
+         try:
+            self.process(curFolder, category, files, plan)
+         except KeyboardInterrupt:
+            quit_gracefully()
       
-      # CTRL+C signal
-      signal.signal(signal.SIGINT, quit_gracefully)
+      plan.printSummary()
+      if self.planFile is not None:
+         plan.dump(self.planFile)
       
-      # verbose
-      print ""
-      print "  Processing folder '" + curFolder + "'..."   
+      # simulation only plans
+      if self.simulate:
+         self.walked = []
+         return
+      
+      cleaned = self.execute(plan)
+      self.recordFolders(cleaned)
+   
+   # ===================================
+   # Watches the source folder (inotify) and synchronizes changed folders
+   #  - events are collected until nothing changed for watchDelay seconds
+   #  - new folders are synchronized with all subfolders
+   # ===================================
+   def watchChanges(self):
+      manager = pyinotify.WatchManager()
+      mask = pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+      notifier = pyinotify.Notifier(manager, self.watchEvent, timeout=500)
+      manager.add_watch(self.sourceFolder, mask, rec=True, auto_add=True)
       
-      # skip folder (and subfolders) if .nosync
-      if os.path.exists(os.path.join(curFolder, ".nosync")):
-         print "    Folder '" + curFolder + "' and all subfolders skipped."
+      print ""
+      print "  Watching '" + self.sourceFolder + "' for changes (CTRL+C to stop)..."
+      self.watchFolders = {}
+      last = time.time()
+      try:
+         while True:
+            if notifier.check_events():
+               notifier.read_events()
+               notifier.process_events()
+               last = time.time()
+            elif self.watchFolders and time.time() - last >= self.watchDelay:
+               folders = self.watchFolders
+               self.watchFolders = {}
+               self.client.refresh()
+               self.sync(self.watchWalk(folders))
+               if self.state is not None:
+                  self.state.commit()
+               if self.metricsFolder is not None:
+                  metrics.write(self.metricsFolder, self.shard[0] + 1 if self.shard is not None else None)
+      finally:
+         notifier.stop()
+   
+   def watchEvent(self, event):
+      # ignore system files (.part files, etc.)
+      if event.name.startswith(".") and event.name != ".nosync":
          return
+      folder = event.path
+      self.watchFolders[folder] = self.watchFolders.get(folder, False)
+      
+      # new folder (or moved into source folder) => all files and subfolders
+      if event.dir and event.mask & (pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO):
+         self.watchFolders[event.pathname] = True
+   
+   # Yields changed folders (same as walk) except deleted and .nosync folders
+   def watchWalk(self, folders):
+      walked = []
+      for folder, recursive in sorted(folders.items()):
+         # already part of a new folder (walked with all subfolders)
+         if any([folder.startswith(w + os.sep) for w in walked]):
+            continue
+         if recursive:
+            walked.append(folder)
 
-      # build output folder path
-      category = curFolder.replace(self.sourceFolder,"")
+         # source folder (category paths are relative to it)
+         folder = self.sourceFolder if os.path.join(folder, "") == os.path.join(self.sourceFolder, "") else folder
+         if not os.path.isdir(folder) or self.isSkipped(os.path.dirname(folder.rstrip(os.sep))):
+            continue
+         for el in self.walk(folder, recursive, False):
+            yield el
+   
+   # Checks if folder (or one of its parents in the source folder) contains .nosync
+   def isSkipped(self, folder):
+      while len(os.path.join(folder, "")) > len(os.path.join(self.sourceFolder, "")):
+         if os.path.exists(os.path.join(folder, ".nosync")):
+            return True
+         folder = os.path.dirname(folder)
+      return False
+   
+   # ===================================
+   # Walks through the source folder (iterative, depth-first)
+   # Yields (folder, category, file entries) for each folder to process
+   #  - folders containing .nosync are skipped (with all subfolders)
+   #  - entries come from scandir (file type without extra stat calls)
+   #  - subfolders are skipped if not recursive
+   #  - folders whose files didn't change since last synchronization aren't processed (only subfolders are checked)
+   #    unless snapshot is False (ex: folders changed in watch mode)
+   #  - folders with same modification time aren't even listed if pruneFolders (recorded subfolders are checked)
+   # ===================================
+   def walk(self, folder, recursive = True, snapshot = True):
+      stack = [folder]
+      while stack:
+         curFolder = stack.pop()
+         
+         # unchanged folder => one stat instead of listing and checking its files
+         if snapshot and self.pruneFolders and not self.fullCheck:
+            subfolders = self.unchangedTree(curFolder)
+            if subfolders is not None:
+               metrics.add('walk', 'pruned', 1)
+               if recursive:
+                  stack.extend(reversed(self.shardFolders(curFolder, subfolders)))
+               continue
+         
+         start = time.time()
+         # (before listing, changes during the listing are noticed next time)
+         mtime = os.stat(curFolder).st_mtime if self.pruneFolders else None
+         entries = scandir(curFolder) if scandir is not None else [DirEntry(curFolder, el) for el in os.listdir(curFolder)]
+         files = []
+         folders = []
+         nosync = False
+         for entry in entries:
+            # skip folder (and subfolders) if .nosync
+            if entry.name == ".nosync":
+               nosync = True
+               break
+            
+            # ignore system files
+            if entry.name.startswith("."):
+               continue
+            
+            if entry.is_file():
+               files.append(entry)
+            elif entry.is_dir():
+               folders.append(entry.path)
+         metrics.add('walk', 'folders', 1, time.time() - start)
+         metrics.add('walk', 'files', len(files))
+         
+         if nosync:
+            print ""
+            print "  Processing folder '" + curFolder + "'..."
+            print "    Folder '" + curFolder + "' and all subfolders skipped."
+            continue
+         
+         # same file names, sizes and modification times as last synchronization
+         if snapshot and not self.fullCheck and self.unchangedFolder(curFolder, files):
+            metrics.add('walk', 'unchanged', 1)
+            if self.pruneFolders and not self.simulate:
+               self.state.updateTree(curFolder, mtime, [os.path.basename(f) for f in folders])
+         
+         # build output folder path (files of source folder belong to first shard)
+         elif self.shard is None or self.shard[0] == 0 or curFolder != self.sourceFolder:
+            # verbose
+            print ""
+            print "  Processing folder '" + curFolder + "'..."   
+            
+            category = curFolder.replace(self.sourceFolder,"")
+            yield curFolder, category, files
+            
+            # recorded once all files are uploaded
+            if self.state is not None:
+               self.walked.append((curFolder, files, folders, mtime))
+         
+         # subfolders processed in listing order
+         if recursive:
+            stack.extend(reversed(self.shardFolders(curFolder, folders)))
+   
+   # ===================================
+   # Returns subfolders of the source folder belonging to this shard (stable hash of album name)
+   # (other folders are returned unchanged)
+   # ===================================
+   def shardFolders(self, folder, subfolders):
+      if self.shard is None or folder != self.sourceFolder:
+         return subfolders
+      index, count = self.shard
+      return [f for f in subfolders if int(hashlib.md5(os.path.basename(f)).hexdigest(), 16) % count == index]
+   
+   # ===================================
+   # Checks if files of a folder didn't change since last synchronization
+   # (files modified in place change their size or modification time)
+   # ===================================
+   def unchangedFolder(self, folder, files):
+      if self.state is None:
+         return False
+      
+      snapshot = self.state.getFolder(folder)
+      if snapshot is None or (self.delete and not snapshot[1]):
+         return False
+      try:
+         return self.entriesDigest(files) == snapshot[0]
+      except OSError:
+         return False
+   
+   # ===================================
+   # Returns subfolders of a folder which didn't change since last synchronization (None otherwise)
+   # Adding, removing or renaming files changes the folder modification time, files modified
+   # in place don't (see PruneFolders)
+   # ===================================
+   def unchangedTree(self, folder):
+      if self.state is None:
+         return None
+      
+      tree = self.state.getTree(folder)
+      if tree is None or (self.delete and not tree[2]):
+         return None
+      try:
+         if os.stat(folder).st_mtime != tree[0]:
+            return None
+      except OSError:
+         return None
+      return [os.path.join(folder, name) for name in tree[1]]
+   
+   # Returns digest of file names, sizes and modification times (stat of scandir entries)
+   def entriesDigest(self, files):
+      entries = []
+      for entry in files:
+         fileStat = entry.stat()
+         entries.append(entry.name + "|" + str(fileStat.st_size) + "|" + repr(fileStat.st_mtime))
+      return hashlib.sha1("\n".join(entries)).hexdigest()
+   
+   # ===================================
+   # Records walked folders
+   # Folders with files which couldn't be synchronized are checked again next time
+   # ===================================
+   def recordFolders(self, cleaned = True):
+      walked = self.walked
+      self.walked = []
+      if self.state is None or not cleaned:
+         return
+      
+      for curFolder, files, folders, mtime in walked:
+         synchronized = True
+         for entry in files:
+            filename, fileext = os.path.splitext(entry.name)
+            if fileext.lower() in IMAGE_EXTENSIONS + VIDEO_EXTENSIONS and not self.state.isSynchronized(entry.path, entry.stat()):
+               synchronized = False
+               break
+         if synchronized:
+            self.state.updateFolder(curFolder, self.entriesDigest(files), self.delete, mtime, [os.path.basename(f) for f in folders])
+   
+   # ===================================
+   # Plans the synchronization of one folder
+   # ===================================
+   def process(self, curFolder, category, files, plan):
       
       # create output folder if not exist
       if not self.client.categoryExists(category):
          print "    Category '" + category + "' doesn't exist. Creating..."
-         if not self.simulate:
-            self.client.addCategory(category)
+         plan.add('category', category=category)
       
-      # loop over all elements
+      # skip files without touching target if already synchronized
       processed = set([])
+      pending = []
       elDone = 0
       elSkipped = 0
       elDeleted = 0
-      for el in os.listdir(curFolder):
-         try:
-            curPath = os.path.join(curFolder,el)
-            
-            # ignore system files
-            if el.startswith("."):
-               continue
+      for entry in files:
+         # add element into set (necessary for --delete option)
+         el = entry.name
+         processed.add(el)
+         
+         filePath = entry.path
+         fileStat = entry.stat()
+         if self.state is not None and not self.fullCheck and self.state.isSynchronized(filePath, fileStat):
+            elSkipped += 1
+         else:
+            pending.append((el, filePath, fileStat))
+      
+      # compare content with previously synchronized files (modified or moved files)
+      contents = self.checkContents(pending)
+      
+      # loop over remaining files
+      videos = []
+      for el, filePath, fileStat in pending:
+         content = contents.get(filePath, {})
+         md5 = content.get('md5')
+         
+         # check if file exists
+         if not content.get('changed') and self.client.fileExists(category, el):
+            # already on target => remember it for next runs
+            if self.state is not None:
+               plan.add('record', path=filePath, stat=fileStat, md5=md5, remote=self.client.fileReference(category, el))
+            elSkipped += 1
+         
+         # same image already uploaded from another folder => link it
+         elif content.get('link') is not None:
+            print "    Linking moved image '" + el + "'..."
+            plan.add('link', category=category, name=el, path=filePath, stat=fileStat, md5=md5,
+                     image=content['link'], remoteSum=content['remoteSum'])
             
-            # file => process image
-            if os.path.isfile(curPath):
-               # add element into set (necessary for --delete option)
-               processed.add(el)
-               
-               # retrieve relative paths
-               filePath  = curPath
-               
-               # check if file exists
-               if not self.client.fileExists(category, el):
+            # increase counter
+            elDone += 1
+         
+         else:
+            # file is an image?
+            filename, fileext = os.path.splitext(el)
+            if fileext.lower() in IMAGE_EXTENSIONS:
+               print "    Processing image '" + el + "'..."
+               # (image to replace must still be on target under the same name, otherwise added as new image)
+               replace = content.get('replace')
+               if replace is not None and str(self.client.fileReference(category, el)) != replace:
+                  replace = None
+               plan.add('image', category=category, name=el, path=filePath, stat=fileStat, md5=md5,
+                        size=fileStat.st_size, replace=replace)
                
-                  # file is an image?
-                  filename, fileext = os.path.splitext(el)
-                  if fileext.lower() in [".jpg",".jpeg",".gif",".png"]:
-                     print "    Processing image '" + el + "'..."
-                                       
-                     # create images
-                     if not self.simulate:
-                        self.client.addImage(self.createImage(filePath), category, el)
-                     
-                     # increase counter
-                     elDone += 1
-                  
-                  # file is a video?
-                  elif fileext.lower() in [".ogv",".ogg",".mp4"]:
-                     print "    Processing video '" + el + "'..."
-                     
-                     # create videos
-                     if not self.simulate:
-                        video, thumb = self.createVideo(filePath)
-                        self.client.addOther(video, thumb, category, el)
-                     
-                     # increase counter
-                     elDone += 1
-                  
-               else:
-                  elSkipped += 1
+               # increase counter
+               elDone += 1
             
-            # folder => process sub-folder
-            elif os.path.isdir(curPath):
-               self.process(curPath)
-            
-                  
+            # file is a video?
+            elif fileext.lower() in VIDEO_EXTENSIONS:
+               print "    Processing video '" + el + "'..."
+               videos.append(plan.add('video', category=category, name=el, path=filePath, stat=fileStat, md5=md5, size=fileStat.st_size))
+               
+               # increase counter
+               elDone += 1
+      
+      # capture date of videos to transcode (single exiftool command, added to representatives)
+      # (date is extracted from the filename if not available, not read by simulation)
+      metadata = self.metadata.read([action['path'] for action in videos]) if not self.simulate else {}
+      for action in videos:
+         values = metadata.get(action['path'], {})
+         action['date'] = values.get('date') or self.utilExtractTime(action['name']) or None
+
+      # non-processed elements will be deleted at the end
+      if self.delete:
+         for category, el, ref in self.client.cleanCategory(category, processed):
+            print "    Element '" + el + "' has no match in source folder. Marked for deletion..."
+            plan.add('delete', category=category, name=el, ref=ref)
+            elDeleted += 1
+         
+      metrics.add('files', 'processed', elDone)
+      metrics.add('files', 'skipped', elSkipped)
+      metrics.add('files', 'stale', elDeleted)
+      
+      # verbose
+      print "    (" + str(elDone) + " elements processed / " + str(elSkipped) + " elements skipped / " + str(elDeleted) + " elements to delete)"
+
+   # ===================================
+   # Executes a plan
+   #  - categories, known files and links first (sequential)
+   #  - videos (longest jobs) are transcoded while images are converted and uploaded
+   #  - deletions once all files are uploaded
+   # ===================================
+   def execute(self, plan):
+      for action in plan.actions('category'):
+         self.client.addCategory(action['category'])
+      for action in plan.actions('record'):
+         self.state.update(action['path'], action['stat'], action['remote'], action['md5'])
+      for action in plan.actions('link'):
+         self.client.linkImage(action['image'], action['category'])
+         self.state.update(action['path'], action['stat'], action['image'], action['md5'], action['remoteSum'])
+      
+      # start upload threads
+      self.uploadThreads = []
+      for i in range(self.uploads):
+         t = threading.Thread(target=self.uploadWorker)
+         t.daemon = True
+         t.start()
+         self.uploadThreads.append(t)
+      
+      videoResults = [self.videoPool.apply_async(self.videoWorker, (action,)) for action in plan.actions('video')]
+      for action in plan.actions('image'):
+         try:
+            result = self.pool.apply_async(self.createImage, (action['path'], action['md5']))
+            self.queueUpload((result, action['category'], action['name'], action['path'], action['stat'], action['md5'], action['replace']))
          except KeyboardInterrupt:
             quit_gracefully()
+      
+      # wait for remaining uploads (one stop marker per thread)
+      for t in self.uploadThreads:
+         self.queueUpload(None)
+      for t in self.uploadThreads:
+         while t.is_alive():
+            t.join(1)
+      
+      # wait for remaining videos
+      for result in videoResults:
+         while not result.ready():
+            result.wait(1)
+      self.checkUploads()
+      
+      # delete elements which have no match in source folders
+      return self.deleteElements([(a['category'], a['name'], a['ref']) for a in plan.actions('delete')])
 
 
-      # delete non-processed elements
-      if self.delete and os.path.exists(curFolder) and os.path.isdir(curFolder):
-         if not self.simulate:
-            elDeleted = self.client.cleanCategory(category, processed, self.delete == "Prompt")
+   # ===================================
+   # Deletes all elements marked for deletion (confirmed once in prompt mode)
+   # ===================================
+   # Returns False if deletion was skipped
+   def deleteElements(self, elements):
+      if not elements:
+         return True
+      
+      print ""
+      print "  " + str(len(elements)) + " elements have no match in source folders."
+      if self.delete == "Prompt":
+         for category, el, ref in elements:
+            print "    " + os.path.join(category, el)
+         if not raw_input("  Delete these elements? [y/N] ").lower().startswith('y'):
+            print "  Deletion skipped."
+            return False
+      
+      deleted = self.client.deleteElements(elements)
+      metrics.add('files', 'deleted', deleted)
+      print "  " + str(deleted) + " elements deleted."
+      return True
+   
+   
+   # ===================================
+   # Compares files with previously synchronized content (requires sync state)
+   #  - changed: content differs from last synchronization (replace: remote image)
+   #  - link:    same content already uploaded from another path and still on target
+   # Files are only hashed for targets with checksums (web API), file and FTP targets compare size and modification time
+   # Simulation only hashes files with the size of a synchronized file (and doesn't store hashes)
+   # ===================================
+   def checkContents(self, files):
+      contents = {}
+      if self.state is None:
+         return contents
+      
+      candidates = {}
+      for el, filePath, fileStat in files:
+         filename, fileext = os.path.splitext(el)
+         if not fileext.lower() in IMAGE_EXTENSIONS + VIDEO_EXTENSIONS:
+            continue
          
-      # verbose
-      print "    (" + str(elDone) + " elements processed / " + str(elSkipped) + " elements skipped / " + str(elDeleted) + " elements deleted)"
+         # no checksums on target (nothing to link) => files aren't hashed
+         # (synchronized before with other size or modification time => changed)
+         previous = self.state.get(filePath)
+         if not self.client.checksums:
+            contents[filePath] = {'md5': None}
+            if previous is not None and not self.state.isSynchronized(filePath, fileStat):
+               contents[filePath].update({'changed': True, 'replace': previous[1]})
+            continue
+         
+         # (other size => content differs from all synchronized files)
+         if self.simulate and not self.state.hasSize(fileStat.st_size):
+            md5 = None
+         else:
+            md5 = self.state.checksum(filePath, fileStat, not self.simulate)
+         content = {'md5': md5}
+         if previous is not None and previous[0] is not None and previous[0] != md5:
+            content['changed'] = True
+            content['replace'] = previous[1]
+         elif md5 is not None:
+            for path, remote, remoteSum in self.state.find(md5):
+               if path != filePath and remoteSum is not None:
+                  candidates[filePath] = remoteSum
+                  content['remoteSum'] = remoteSum
+                  break
+         contents[filePath] = content
+      
+      # check (in batches) that images still exist on target
+      if candidates:
+         existing = self.client.imagesExist(list(set(candidates.values())))
+         for filePath, remoteSum in candidates.items():
+            contents[filePath]['link'] = existing.get(remoteSum)
+      
+      return contents
 
 
+   # ===================================
+   # Puts a conversion into the upload queue
+   # (blocks while the queue is full, which bounds pending conversions)
+   # ===================================
+   def queueUpload(self, item):
+      while True:
+         self.checkUploads()
+         try:
+            # wait with timeout (keeps CTRL+C working)
+            self.uploadQueue.put(item, True, 1)
+            return
+         except Queue.Full:
+            pass
+   
+   # ===================================
+   # Video worker: transcodes a video and hands it over to the client
+   # ===================================
+   def videoWorker(self, action):
+      category, el, filePath, fileStat, md5 = action['category'], action['name'], action['path'], action['stat'], action['md5']
+      try:
+         # failed transcoding => not uploaded (and not recorded as synchronized)
+         try:
+            video, thumb = self.createVideo(filePath, md5, action.get('date'))
+         except ConversionError as e:
+            print "  [WARN] Video '" + filePath + "' couldn't be transcoded (" + str(e) + "). Skipping..."
+            return
+         try:
+            remote = self.client.addOther(video, thumb, category, el)
+            if self.state is not None and remote is not None:
+               self.state.update(filePath, fileStat, remote, md5)
+         finally:
+            for f in (video, thumb):
+               if os.path.exists(f):
+                  os.remove(f)
+      except BaseException as e:
+         print "  [ERROR] Video '" + filePath + "' couldn't be added: " + str(e)
+         self.uploadFailure = e
+   
+   # ===================================
+   # Stops if an upload thread failed
+   # ===================================
+   def checkUploads(self):
+      if self.uploadFailure is not None:
+         print "  [ERROR] Upload failed! Stopping..."
+         sys.exit(1)
+   
+   # ===================================
+   # Upload thread: hands converted images over to the client
+   # ===================================
+   def uploadWorker(self):
+      while True:
+         item = self.uploadQueue.get()
+         if item is None:
+            return
+         
+         result, category, el, filePath, fileStat, md5, replace = item
+         try:
+            # failed conversion => not uploaded (and not recorded as synchronized)
+            try:
+               tempImage, image = result.get()
+            except ConversionError as e:
+               print "  [WARN] Image '" + filePath + "' couldn't be converted (" + str(e) + "). Skipping..."
+               continue
+            derivatives = self.derivativeFiles(tempImage)
+            try:
+               # (checksum of the uploaded image is only needed to find it again on target)
+               remoteSum = checksum(image) if self.state is not None and self.client.checksums else None
+               remote = self.client.addImage(image, category, el, replace)
+               # (derivatives must be newer than the image)
+               if remote is not None and derivatives:
+                  self.client.addDerivatives(derivatives, category, el, replace is not None)
+               if self.state is not None and remote is not None:
+                  self.state.update(filePath, fileStat, remote, md5, remoteSum)
+            finally:
+               if image is not tempImage:
+                  image.close()
+               for f in [tempImage] + [d[1] for d in derivatives]:
+                  if os.path.exists(f):
+                     os.remove(f)
+         except BaseException as e:
+            print "  [ERROR] Image '" + filePath + "' couldn't be added: " + str(e)
+            self.uploadFailure = e
+            return
+   
+   
    # ===================================
    # Generates a new image from the source
    #  - Automatically rotates based on EXIF information
    #  - Applies desired quality
    #  - Resizes image (if desired)
+   #  - Generates derivatives from the new image (see derivativeFiles)
+   # Returns the temporary file and the new image (same file or in-memory copy, see imageBuffer)
    # ===================================
-   def createImage(self, srcFile):
+   def createImage(self, srcFile, md5 = None):
 
-      # temporary file
-      tempfile = os.path.join(self.tempFolder, 'temp.jpg')
+      # temporary file (unique, conversions run in parallel)
+      # (remains empty if the image is kept in memory, bigger images are written into temp folder)
+      fd, tempImage = tempfile.mkstemp(suffix='.jpg', dir=self.tempFolder)
+      os.close(fd)
+      tempFiles = [tempImage] + [d[1] for d in self.derivativeFiles(tempImage)]
+      
+      # already converted (cache)
+      if self.cache is not None:
+         md5 = checksum(srcFile) if md5 is None else md5
+         params = ['image', md5, self.imageQuality, self.imageResize, self.toolVersion(self.imageEngine)]
+         key = self.cache.key(*(params + [self.derivatives] if self.derivatives else params))
+         if self.cache.get(key, tempFiles):
+            return tempImage, tempImage
+      
+      image = tempfile.SpooledTemporaryFile(self.imageBuffer, dir=self.tempFolder) if self.imageBuffer > 0 else tempImage
+      try:
+         with metrics.measure('createImage', self.imageEngine):
+            self.convertImage(srcFile, tempImage, image if image is not tempImage else None)
+         self.checkOutputs([image] + tempFiles[1:])
+      except:
+         if image is not tempImage:
+            image.close()
+         for f in tempFiles:
+            if os.path.exists(f):
+               os.remove(f)
+         raise
+      metrics.add('createImage', self.imageEngine, bytes = fileSize(image) + sum([os.path.getsize(f) for f in tempFiles[1:] if os.path.exists(f)]))
+      if self.cache is not None:
+         self.cache.put(key, [image] + tempFiles[1:])
+      return tempImage, image
+   
+   # Raises ConversionError if an output is missing or empty
+   # (temporary files are created before the conversion, tools could fail without error status)
+   def checkOutputs(self, files):
+      for f in files:
+         if (isinstance(f, basestring) and not os.path.exists(f)) or fileSize(f) == 0:
+            raise ConversionError("no output written into '" + (f if isinstance(f, basestring) else "memory") + "'")
+   
+   # Returns derivatives [(type, file)] generated along with given image (same name with type suffix)
+   def derivativeFiles(self, tempImage):
+      name, ext = os.path.splitext(tempImage)
+      return [(type, name + "-" + type + ext) for type, width, height in self.derivatives]
+   
+   # (image is written into output instead of tempImage if given)
+   def convertImage(self, srcFile, tempImage, output = None):
+      
+      # in-process engine (falls back to convert for unsupported images or options)
+      if self.imageEngine == 'pil' and self.createImagePIL(srcFile, tempImage, output):
+         return
+      if output is not None:
+         output.seek(0)
+         output.truncate()
 
-      # command
-      imCommand = 'convert -auto-orient -quality #QUALITY #RESIZEOPT "#SRCFILE" "#DESTFILE"'
+      # command (one thread per convert if several conversions run in parallel)
+      imCommand = 'convert #LIMIT -auto-orient -quality #QUALITY #RESIZEOPT "#SRCFILE" "#DESTFILE"'
+      imCommand = imCommand.replace('#LIMIT','-limit thread 1') if self.jobs > 1 else imCommand.replace('#LIMIT','')
       
       # replace place holders by values
       imCommand = imCommand.replace('#QUALITY',str(self.imageQuality)) if self.imageQuality is not None else imCommand.replace('#QUALITY','95')
-      imCommand = imCommand.replace('#RESIZEOPT',"-resize " + self.imageResize) if self.imageResize is not None else imCommand.replace('#RESIZEOPT','')
+      imCommand = imCommand.replace('#RESIZEOPT','-resize "' + self.imageResize + '"') if self.imageResize is not None else imCommand.replace('#RESIZEOPT','')
+      destFile = tempImage if output is None else 'jpg:-'
       imCommand = imCommand.replace('#SRCFILE',srcFile)
-      imCommand = imCommand.replace('#DESTFILE',tempfile)
+      imCommand = imCommand.replace('#DESTFILE',destFile)
+      
+      # derivatives from the resized image (same decoding, never enlarged, square is cropped)
+      derivatives = []
+      for (type, path), (t, width, height) in zip(self.derivativeFiles(tempImage), self.derivatives):
+         size = str(width) + "x" + str(height)
+         resize = '-thumbnail "' + size + '^" -gravity center -extent ' + size if type == 'sq' else '-thumbnail "' + size + '>"'
+         derivatives.append('\\( +clone ' + resize + ' -write "' + path + '" +delete \\)')
+      if derivatives:
+         imCommand = imCommand.replace('"' + destFile + '"', '-write "' + destFile + '" ' + " ".join(derivatives) + ' null:')
+      
+      # execute command (output read through a pipe if given)
+      if output is None:
+         runCommand(imCommand)
+      else:
+         process = subprocess.Popen(imCommand, shell=True, stdout=subprocess.PIPE)
+         shutil.copyfileobj(process.stdout, output, 64 * 1024)
+         status = process.wait()
+         if status != 0:
+            raise ConversionError("'convert' failed with exit status " + str(status))
+   
+   
+   # ===================================
+   # Generates a new image from the source using PIL (same result as createImage)
+   #  - Decodes JPEG at reduced resolution if the target is much smaller
+   # Returns False if the image (or resize option) isn't supported
+   # ===================================
+   def createImagePIL(self, srcFile, destFile, output = None):
       
-      # execute command
-      os.system(imCommand)
+      # resize option: WxH with optional '>' (only shrink larger images)
+      box = None
+      if self.imageResize is not None:
+         match = re.match('^([0-9]+)x([0-9]+)(>?)$', self.imageResize.strip())
+         if match is None:
+            return False
+         box = (int(match.group(1)), int(match.group(2)), match.group(3) == '>')
       
-      return tempfile
+      try:
+         img = Image.open(srcFile)
+         
+         # EXIF orientation (274) => transpositions
+         orientation = 1
+         exif = img.getexif() if hasattr(img, 'getexif') else None
+         if exif is not None:
+            orientation = exif.get(274, 1)
+         transpose = {2: [Image.FLIP_LEFT_RIGHT], 3: [Image.ROTATE_180], 4: [Image.FLIP_TOP_BOTTOM],
+                      5: [Image.ROTATE_270, Image.FLIP_LEFT_RIGHT], 6: [Image.ROTATE_270],
+                      7: [Image.ROTATE_90, Image.FLIP_LEFT_RIGHT], 8: [Image.ROTATE_90]}.get(orientation, [])
+         
+         # target size (box applies to the oriented image)
+         width, height = img.size
+         if orientation in (5, 6, 7, 8):
+            width, height = height, width
+         size = None
+         if box is not None:
+            ratio = min(float(box[0]) / width, float(box[1]) / height)
+            if ratio < 1 or not box[2]:
+               size = (max(1, int(round(width * ratio))), max(1, int(round(height * ratio))))
+         
+         # reduced-resolution decoding (JPEG only, keeps at least target size)
+         if size is not None:
+            draftSize = (size[1], size[0]) if orientation in (5, 6, 7, 8) else size
+            img.draft('RGB', draftSize)
+         
+         if img.mode != 'RGB':
+            img = img.convert('RGB')
+         for method in transpose:
+            img = img.transpose(method)
+         if size is not None and size != img.size:
+            img = img.resize(size, Image.ANTIALIAS)
+         
+         # keep EXIF metadata (image is now upright)
+         options = {'quality': self.imageQuality if self.imageQuality is not None else 95}
+         if exif is not None and len(exif) > 0:
+            exif[274] = 1
+            options['exif'] = exif.tobytes()
+         if 'icc_profile' in img.info:
+            options['icc_profile'] = img.info['icc_profile']
+         # (PIL would move in-memory files to disk by calling fileno(), it only needs write())
+         dest = destFile if output is None else collections.namedtuple('Writer', 'write')(output.write)
+         img.save(dest, 'JPEG', **options)
+         
+         # derivatives from the resized image (never enlarged, square is cropped)
+         for (type, path), (t, width, height) in zip(self.derivativeFiles(destFile), self.derivatives):
+            derivative = img
+            if type == 'sq':
+               side = min(img.size)
+               left, top = (img.size[0] - side) / 2, (img.size[1] - side) / 2
+               derivative = img.crop((left, top, left + side, top + side))
+            ratio = min(float(width) / derivative.size[0], float(height) / derivative.size[1])
+            if ratio < 1:
+               derivative = derivative.resize((max(1, int(round(derivative.size[0] * ratio))), max(1, int(round(derivative.size[1] * ratio)))), Image.ANTIALIAS)
+            derivative.save(path, 'JPEG', quality=options['quality'])
+         return True
+      except (IOError, ValueError) as e:
+         print "  [WARN] Image '" + srcFile + "' couldn't be converted with PIL (" + str(e) + "). Using 'convert'..."
+         return False
    
    
    # ===================================
@@ -582,45 +2812,93 @@ class Folder2Piwigo(object):
    #  - Applies desired quality
    #  - Optimizes compression (reduces size)
    #  - Extracts an image from the video as representative
-   #  - Adds EXIF date to representative
+   #  - Adds EXIF date to representative (capture date or date from filename)
+   # With avconv encoder, video and representative are generated in a single pass
    # ===================================
-   def createVideo(self, srcFile):
+   def createVideo(self, srcFile, md5 = None, date = None):
          
-      # folders
-      tempThumb = os.path.join(self.tempFolder, 'temp.jpg')
-      tempVideo = os.path.join(self.tempFolder, 'vid.ogg')
+      # temporary files (unique, videos are transcoded in parallel)
+      fd, tempThumb = tempfile.mkstemp(suffix='.jpg', dir=self.tempFolder)
+      os.close(fd)
+      fd, tempVideo = tempfile.mkstemp(suffix='.ogg', dir=self.tempFolder)
+      os.close(fd)
       
-      # commands
-      thumbCommand = 'avconv -y -i "#SRCFILE" -vframes 1 -ss 00:00:01 -an -vcodec mjpeg -f rawvideo -v quiet "#DESTFILE"';
-      vidCommand   = 'ffmpeg2theora --framerate 24 --videoquality #QUALITY --optimize -o "#DESTFILE" "#SRCFILE" ';
-      exifCommand  = 'exiftool -EXIF:DateTimeOriginal="#DATE" "#SRCFILE"';
+      # already transcoded (cache)
+      if self.cache is not None:
+         md5 = checksum(srcFile) if md5 is None else md5
+         key = self.cache.key('video', md5, self.videoQuality, self.videoEncoder, self.toolVersion(self.videoEncoder))
+         if self.cache.get(key, [tempVideo, tempThumb]):
+            return tempVideo, tempThumb
       
-      # generate thumbnail
-      thumbCommand = thumbCommand.replace('#SRCFILE',srcFile)
-      thumbCommand = thumbCommand.replace('#DESTFILE',tempThumb)
-      os.system(thumbCommand)
+      try:
+         with metrics.measure('createVideo', self.videoEncoder):
+            self.transcodeVideo(srcFile, tempVideo, tempThumb, date)
+         self.checkOutputs([tempVideo, tempThumb])
+      except:
+         for f in (tempVideo, tempThumb):
+            if os.path.exists(f):
+               os.remove(f)
+         raise
+      metrics.add('createVideo', self.videoEncoder, bytes = os.path.getsize(tempVideo) + os.path.getsize(tempThumb))
+      if self.cache is not None:
+         self.cache.put(key, [tempVideo, tempThumb])
+      return tempVideo, tempThumb
+   
+   def transcodeVideo(self, srcFile, tempVideo, tempThumb, date = None):
       
-      # re-encode video (less quality and optimized compression)
-      vidCommand = vidCommand.replace('#SRCFILE',srcFile)
-      vidCommand = vidCommand.replace('#DESTFILE',tempVideo)
-      vidCommand = vidCommand.replace('#QUALITY',str(self.videoQuality)) if self.videoQuality is not None else vidCommand.replace('#QUALITY','5')
-      os.system(vidCommand)
+      # commands
+      thumbCommand = 'avconv -y -threads #THREADS -i "#SRCFILE" -vframes 1 -ss 00:00:01 -an -vcodec mjpeg -f rawvideo -v quiet "#DESTFILE"';
+      vidCommand   = 'ffmpeg2theora --framerate 24 --videoquality #QUALITY --optimize -o "#DESTFILE" "#SRCFILE" ';
+      onePassCommand = 'avconv -y -threads #THREADS -i "#SRCFILE" -r 24 -vcodec libtheora -q:v #QUALITY -acodec libvorbis -f ogg -v quiet "#DESTFILE" ' + \
+                       '-vframes 1 -ss 00:00:01 -an -vcodec mjpeg -f rawvideo "#THUMBFILE"';
       
-      # extract creation date 
-      createDate = self.utilExtractTime(srcFile)
+      quality = str(self.videoQuality) if self.videoQuality is not None else '5'
+      if self.videoEncoder == 'avconv':
+         # re-encode video and generate thumbnail (single decoding)
+         onePassCommand = onePassCommand.replace('#THREADS',str(self.videoThreads))
+         onePassCommand = onePassCommand.replace('#SRCFILE',srcFile)
+         onePassCommand = onePassCommand.replace('#DESTFILE',tempVideo)
+         onePassCommand = onePassCommand.replace('#THUMBFILE',tempThumb)
+         onePassCommand = onePassCommand.replace('#QUALITY',quality)
+         runCommand(onePassCommand)
+      else:
+         # generate thumbnail
+         thumbCommand = thumbCommand.replace('#THREADS',str(self.videoThreads))
+         thumbCommand = thumbCommand.replace('#SRCFILE',srcFile)
+         thumbCommand = thumbCommand.replace('#DESTFILE',tempThumb)
+         runCommand(thumbCommand)
+         
+         # re-encode video (less quality and optimized compression)
+         vidCommand = vidCommand.replace('#SRCFILE',srcFile)
+         vidCommand = vidCommand.replace('#DESTFILE',tempVideo)
+         vidCommand = vidCommand.replace('#QUALITY',quality)
+         runCommand(vidCommand)
       
-      # inject exif metadata
-      exifCommand = exifCommand.replace('#SRCFILE',tempThumb)
-      exifCommand = exifCommand.replace('#DATE',createDate)
-      os.system(exifCommand)
-
-      return tempVideo, tempThumb
+      # inject exif metadata (exiftool process is kept running)
+      createDate = date or self.utilExtractTime(srcFile)
+      if createDate:
+         self.metadata.write([(tempThumb, {'EXIF:DateTimeOriginal': createDate})])
+   
+   
+   # ===================================
+   # Returns the version of a conversion tool (part of cache keys)
+   # ===================================
+   def toolVersion(self, tool):
+      if not tool in self.toolVersions:
+         if tool == 'pil':
+            self.toolVersions[tool] = 'PIL ' + getattr(Image, '__version__', getattr(Image, 'VERSION', ''))
+         elif tool == 'convert':
+            self.toolVersions[tool] = commandOutput('convert -version')
+         else:
+            self.toolVersions[tool] = commandOutput(tool + ' --version' if tool == 'ffmpeg2theora' else tool + ' -version')
+      return self.toolVersions[tool]
       
       
 
    # ===================================
    # Utility function which tries to extract the date time from the video
    #    1) From filename (format _YYYYMMDD_HHMMSS)
+   # (used when metadata doesn't provide the capture date, see ExifTool)
    # ===================================
    def utilExtractTime(self, filename):
       search = re.search('_([0-9]{8}_[0-9]{6})',filename)
@@ -629,7 +2907,10 @@ class Folder2Piwigo(object):
          return ""
       else:
          date = search.group(1)
-         date = time.strptime(date,'%Y%m%d_%H%M%S')
+         try:
+            date = time.strptime(date,'%Y%m%d_%H%M%S')
+         except ValueError:
+            return ""
          return time.strftime("%Y:%m:%d %H:%M:%S", date)
 
 
@@ -645,9 +2926,132 @@ class Folder2Piwigo(object):
 # Prints the script usage and exists
 # ===================================
 def usage():
-   print 'folder2piwigo.py -i <inputfolder> [-o <outputfolder>] [--delete] [--simulate]'
+   print 'folder2piwigo.py -i <inputfolder> [-o <outputfolder>] [--delete] [--simulate] [--full] [--watch] [--plan <file>] [--jobs <n>] [--uploads <n>] [--shard <i/n> | --shards <n>]'
    sys.exit(2)
 
+# ===================================
+# Computes the MD5 checksum of a file (path or file object)
+# ===================================
+def checksum(path):
+   md5 = hashlib.md5()
+   with openFile(path) as f:
+      for block in iter(lambda: f.read(1024 * 1024), ''):
+         md5.update(block)
+   return md5.hexdigest()
+
+# ===================================
+# Opens a file for reading (path) or rewinds it (file object, ex: image kept in memory)
+# File objects are left open
+# ===================================
+@contextlib.contextmanager
+def openFile(file):
+   if isinstance(file, basestring):
+      with open(file, 'rb') as f:
+         yield f
+   else:
+      file.seek(0)
+      yield file
+
+def fileSize(file):
+   if isinstance(file, basestring):
+      return os.path.getsize(file)
+   file.seek(0, os.SEEK_END)
+   return file.tell()
+
+# ===================================
+# Formats a size in bytes (ex: 12.5 MB)
+# ===================================
+def formatSize(size):
+   for unit in ('B', 'KB', 'MB', 'GB'):
+      if size < 1024 or unit == 'GB':
+         return ("%d " if unit == 'B' else "%.1f ") % size + unit
+      size /= 1024.0
+
+# ===================================
+# Hard-links a file (same file system) or copies it
+# ===================================
+def linkOrCopy(src, dest):
+   if os.path.exists(dest):
+      os.remove(dest)
+   try:
+      os.link(src, dest)
+   except OSError:
+      shutil.copy(src, dest)
+
+# ===================================
+# Executes a conversion command (shell)
+# Raises ConversionError if the command fails
+# ===================================
+def runCommand(command):
+   status = subprocess.call(command, shell=True)
+   if status != 0:
+      raise ConversionError("'" + command.split()[0] + "' failed with exit status " + str(status))
+
+# ===================================
+# Returns the first line printed by a command (ex: tool version)
+# ===================================
+def commandOutput(command):
+   try:
+      output = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
+      return output.strip().split("\n")[0]
+   except OSError:
+      return ""
+
+# ===================================
+# Runs one process per shard (same options) and merges their metrics
+#  - top-level albums are split between shards (stable hash), files of the source folder belong to shard 1
+#  - output of shard i is written into TempFolder/folder2piwigo-shard-i.log
+# ===================================
+def runShards(argv, count, tempFolder, metricsFolder):
+   args = []
+   skip = False
+   for arg in argv:
+      if skip:
+         skip = False
+      elif arg == "--shards":
+         skip = True
+      elif not arg.startswith("--shards="):
+         args.append(arg)
+   
+   workers = []
+   for i in range(1, count + 1):
+      shard = str(i) + "/" + str(count)
+      log = os.path.join(tempFolder, SCRIPTNAME + "-shard-" + str(i) + ".log")
+      with open(log, 'w') as out:
+         proc = subprocess.Popen([sys.executable, os.path.abspath(__file__)] + args + ["--shard", shard],
+                                 stdin=subprocess.PIPE, stdout=out, stderr=subprocess.STDOUT)
+      # deletion already confirmed
+      proc.stdin.write("\n")
+      proc.stdin.close()
+      workers.append((shard, log, proc))
+      print "Shard " + shard + " started (pid " + str(proc.pid) + ", output '" + log + "')"
+   
+   failed = False
+   metrics.reset()
+   for shard, log, proc in workers:
+      code = proc.wait()
+      failed = failed or code != 0
+      print "Shard " + shard + (" done" if code == 0 else " FAILED (exit code " + str(code) + ", see '" + log + "')")
+      
+      # merge metrics of shard
+      if metricsFolder is not None:
+         path = os.path.join(metricsFolder, SCRIPTNAME + "-shard-" + shard.split('/')[0])
+         try:
+            with open(path + ".json") as f:
+               metrics.merge(json.load(f))
+            os.remove(path + ".json")
+            os.remove(path + ".prom")
+         except (IOError, OSError, ValueError):
+            print "  [WARN] Metrics of shard " + shard + " not available"
+   
+   if metricsFolder is not None:
+      metrics.write(metricsFolder)
+      files = dict([(s['name'], s['count']) for s in metrics.toDict()['stages'] if s['stage'] == 'files'])
+      print ""
+      print "Files: %d processed, %d skipped, %d stale, %d deleted" % tuple([files.get(n, 0) for n in ('processed', 'skipped', 'stale', 'deleted')])
+   if failed:
+      sys.exit(1)
+
 # ===================================
 # To handle signals
 # ===================================
@@ -664,26 +3068,57 @@ def main(argv):
    sourceFolder = None
    tempFolder = None
    simulate = None
+   syncState = None
+   fullCheck = None
+   jobs = None
+   uploads = None
+   cacheSize = None
+   metricsFolder = None
+   watch = None
+   watchDelay = None
+   pruneFolders = None
+   planFile = None
+   shard = None
+   shards = None
    
    implementation = None
    implSettings = [{}]
    fileTargetFolder = None
+   fileDataFolder = None
    apiServiceURL = None
+   ftpHost = None
+   ftpPort = None
+   ftpUsername = None
+   ftpPassword = None
+   ftpTargetFolder = None
+   ftpDataFolder = None
+   ftpTLS = None
    apiUsername = None
    apiPassword = None
+   apiChunkSize = None
+   apiChunksInFlight = None
+   apiRetries = None
+   apiTimeout = None
+   apiListingCacheSize = None
       
    
    delete = None
    imgResize = None
    imgQuality = None
+   imgEngine = None
+   imgDerivatives = None
+   imgBuffer = None
    videoQuality = None
+   videoEncoder = None
+   videoWorkers = None
+   videoThreads = None
    
    # CTRL+C signal
    signal.signal(signal.SIGINT, quit_gracefully)
     
    # read settings from command line options
    try:
-      opts, args = getopt.getopt(argv,"hdsi:o:t:c:",["config=","input=","output=","temp=","delete", "simulate","version"])
+      opts, args = getopt.getopt(argv,"hdsfwi:o:t:c:j:u:p:",["config=","input=","output=","temp=","jobs=","uploads=","plan=","shard=","shards=","delete", "simulate","full","watch","version"])
       
    except getopt.GetoptError:
       usage()
@@ -698,10 +3133,29 @@ def main(argv):
          fileTargetFolder = arg
       elif opt in ("-t", "--temp"):
          tempFolder = arg
+      elif opt in ("-j", "--jobs"):
+         jobs = int(arg)
+      elif opt in ("-u", "--uploads"):
+         uploads = int(arg)
       elif opt in ("-d", "--delete"):
          delete = True
       elif opt in ("-s", "--simulate"):
          simulate = True
+      elif opt in ("-f", "--full"):
+         fullCheck = True
+      elif opt in ("-w", "--watch"):
+         watch = True
+      elif opt in ("-p", "--plan"):
+         planFile = arg
+      elif opt == "--shard":
+         # format i/n (i = 1..n)
+         search = re.match('^([0-9]+)/([0-9]+)$', arg)
+         if search is None or not 1 <= int(search.group(1)) <= int(search.group(2)):
+            print "[ERROR] Invalid shard '" + arg + "' (expected i/n, ex: 1/4)"
+            sys.exit(1)
+         shard = (int(search.group(1)) - 1, int(search.group(2)))
+      elif opt == "--shards":
+         shards = int(arg)
       elif opt in ("--version"):
          print SCRIPTNAME + " Version " + VERSION
          sys.exit(0)
@@ -722,36 +3176,93 @@ def main(argv):
       # load settings if not already set
       if parser.has_section('File'):
          fileTargetFolder = parser.get('File', 'TargetFolder') if fileTargetFolder is None and parser.has_option('File','TargetFolder') else fileTargetFolder
+         fileDataFolder = parser.get('File', 'DataFolder') if fileDataFolder is None and parser.has_option('File','DataFolder') else fileDataFolder
+      if parser.has_section('FTP'):
+         ftpHost = parser.get('FTP', 'Host') if ftpHost is None and parser.has_option('FTP','Host') else ftpHost
+         ftpPort = parser.getint('FTP', 'Port') if ftpPort is None and parser.has_option('FTP','Port') else ftpPort
+         ftpUsername = parser.get('FTP', 'Username') if ftpUsername is None and parser.has_option('FTP','Username') else ftpUsername
+         ftpPassword = parser.get('FTP', 'Password') if ftpPassword is None and parser.has_option('FTP','Password') else ftpPassword
+         ftpTargetFolder = parser.get('FTP', 'TargetFolder') if ftpTargetFolder is None and parser.has_option('FTP','TargetFolder') else ftpTargetFolder
+         ftpDataFolder = parser.get('FTP', 'DataFolder') if ftpDataFolder is None and parser.has_option('FTP','DataFolder') else ftpDataFolder
+         ftpTLS = parser.getboolean('FTP', 'TLS') if ftpTLS is None and parser.has_option('FTP','TLS') else ftpTLS
       if parser.has_section('API'):
          apiServiceURL = parser.get('API', 'ServiceURL') if apiServiceURL is None and parser.has_option('API','ServiceURL') else apiServiceURL
          apiUsername = parser.get('API', 'Username') if apiUsername is None and parser.has_option('API','Username') else apiUsername
          apiPassword = parser.get('API', 'Password') if apiPassword is None and parser.has_option('API','Password') else apiPassword         
+         apiChunkSize = parser.getint('API', 'ChunkSize') if apiChunkSize is None and parser.has_option('API','ChunkSize') else apiChunkSize
+         apiChunksInFlight = parser.getint('API', 'ChunksInFlight') if apiChunksInFlight is None and parser.has_option('API','ChunksInFlight') else apiChunksInFlight
+         apiRetries = parser.getint('API', 'Retries') if apiRetries is None and parser.has_option('API','Retries') else apiRetries
+         apiTimeout = parser.getint('API', 'Timeout') if apiTimeout is None and parser.has_option('API','Timeout') else apiTimeout
+         apiListingCacheSize = parser.getint('API', 'ListingCacheSize') if apiListingCacheSize is None and parser.has_option('API','ListingCacheSize') else apiListingCacheSize
       if parser.has_section('Settings'):
          sourceFolder = parser.get('Settings', 'SourceFolder') if sourceFolder is None and parser.has_option('Settings','SourceFolder') else sourceFolder
          tempFolder = parser.get('Settings', 'TempFolder') if tempFolder is None and parser.has_option('Settings','TempFolder') else tempFolder
          simulate = parser.getboolean('Settings', 'Simulate') if simulate is None and parser.has_option('Settings','Simulate') else simulate
          delete = parser.get('Settings', 'Delete') if delete is None and parser.has_option('Settings','Delete') else delete
          delete = False if delete == "Off" else delete
+         syncState = parser.getboolean('Settings', 'SyncState') if syncState is None and parser.has_option('Settings','SyncState') else syncState
+         jobs = parser.getint('Settings', 'Jobs') if jobs is None and parser.has_option('Settings','Jobs') else jobs
+         uploads = parser.getint('Settings', 'Uploads') if uploads is None and parser.has_option('Settings','Uploads') else uploads
+         cacheSize = parser.getint('Settings', 'CacheSize') if cacheSize is None and parser.has_option('Settings','CacheSize') else cacheSize
+         metricsFolder = parser.get('Settings', 'MetricsFolder') if metricsFolder is None and parser.has_option('Settings','MetricsFolder') else metricsFolder
+         watch = parser.getboolean('Settings', 'Watch') if watch is None and parser.has_option('Settings','Watch') else watch
+         watchDelay = parser.getint('Settings', 'WatchDelay') if watchDelay is None and parser.has_option('Settings','WatchDelay') else watchDelay
+         pruneFolders = parser.getboolean('Settings', 'PruneFolders') if pruneFolders is None and parser.has_option('Settings','PruneFolders') else pruneFolders
+         planFile = parser.get('Settings', 'PlanFile') if planFile is None and parser.has_option('Settings','PlanFile') else planFile
          implementation = parser.get('Settings', 'Implementation') if implementation is None and parser.has_option('Settings','Implementation') else implementation
          print implementation
-         implementation = implementation if implementation in ('file','api') else 'file'
+         implementation = implementation if implementation in ('file','api','ftp') else 'file'
       if parser.has_section('Images'):
          imgResize = parser.get('Images', 'Resize') if imgResize is None and parser.has_option('Images','Resize') else imgResize
          imgQuality = parser.getint('Images', 'Quality') if imgQuality is None and parser.has_option('Images','Quality') else imgQuality
+         imgEngine = parser.get('Images', 'Engine') if imgEngine is None and parser.has_option('Images','Engine') else imgEngine
+         imgEngine = imgEngine if imgEngine in ('convert','pil') else 'convert'
+         imgDerivatives = parser.get('Images', 'Derivatives') if imgDerivatives is None and parser.has_option('Images','Derivatives') else imgDerivatives
+         imgBuffer = parser.getint('Images', 'MemoryBuffer') if imgBuffer is None and parser.has_option('Images','MemoryBuffer') else imgBuffer
       if parser.has_section('Videos'):
          videoQuality = parser.getint('Videos', 'Quality') if videoQuality is None and parser.has_option('Videos','Quality') else videoQuality
+         videoEncoder = parser.get('Videos', 'Encoder') if videoEncoder is None and parser.has_option('Videos','Encoder') else videoEncoder
+         videoEncoder = videoEncoder if videoEncoder in ('ffmpeg2theora','avconv') else 'ffmpeg2theora'
+         videoWorkers = parser.getint('Videos', 'Workers') if videoWorkers is None and parser.has_option('Videos','Workers') else videoWorkers
+         videoThreads = parser.getint('Videos', 'ThreadsPerJob') if videoThreads is None and parser.has_option('Videos','ThreadsPerJob') else videoThreads
 
    # apply default settings
    simulate = False if simulate is None else simulate
    delete = False if delete is None else delete
+   syncState = True if syncState is None else syncState
+   pruneFolders = False if pruneFolders is None else pruneFolders
+   fullCheck = False if fullCheck is None else fullCheck
+   jobs = multiprocessing.cpu_count() if jobs is None else jobs
+   uploads = 2 if uploads is None else uploads
+   cacheSize = 0 if cacheSize is None else cacheSize
+   metricsFolder = tempFolder if metricsFolder is None else metricsFolder
+   watch = False if watch is None else watch
+   watchDelay = 5 if watchDelay is None else watchDelay
+   shards = 1 if shards is None else shards
+   apiChunkSize = 0 if apiChunkSize is None else apiChunkSize
+   apiChunksInFlight = 4 if apiChunksInFlight is None else apiChunksInFlight
+   apiRetries = 5 if apiRetries is None else apiRetries
+   apiTimeout = 120 if apiTimeout is None else apiTimeout
+   apiListingCacheSize = 100 if apiListingCacheSize is None else apiListingCacheSize
    imgQuality = 95 if imgQuality is None else imgQuality
+   imgEngine = 'convert' if imgEngine is None else imgEngine
+   imgBuffer = 0 if imgBuffer is None else imgBuffer
    videoQuality = 5 if videoQuality is None else videoQuality
+   videoEncoder = 'ffmpeg2theora' if videoEncoder is None else videoEncoder
+   videoWorkers = 1 if videoWorkers is None else videoWorkers
+   videoThreads = 1 if videoThreads is None else videoThreads
    
    # load implementation settings
    if implementation == "file":
-      implSettings = {"targetFolder": fileTargetFolder}
+      implSettings = {"targetFolder": fileTargetFolder, "dataFolder": fileDataFolder}
+   elif implementation == "ftp":
+      implSettings = {"host": ftpHost, "port": 21 if ftpPort is None else ftpPort, "username": ftpUsername, "password": ftpPassword,
+                      "targetFolder": fileTargetFolder if ftpTargetFolder is None else ftpTargetFolder, "tls": ftpTLS is True,
+                      "dataFolder": fileDataFolder if ftpDataFolder is None else ftpDataFolder}
    elif implementation == "api":
-      implSettings = {"serviceURL": apiServiceURL, "username": apiUsername, "password": apiPassword}
+      implSettings = {"serviceURL": apiServiceURL, "username": apiUsername, "password": apiPassword,
+                      "chunkSize": apiChunkSize * 1024, "chunksInFlight": apiChunksInFlight, "tempFolder": tempFolder,
+                      "retries": apiRetries, "timeout": apiTimeout, "listingsSize": apiListingCacheSize}
    
    # print settings (debug)
    print '#################################'
@@ -759,23 +3270,65 @@ def main(argv):
    print 'Source folder:  ', sourceFolder
    if implementation == 'file':
       print 'Target folder:  ', fileTargetFolder
+      print 'Data folder:    ', fileDataFolder
+   elif implementation == 'ftp':
+      print 'FTP server:     ', ftpHost
+      print 'Target folder:  ', fileTargetFolder if ftpTargetFolder is None else ftpTargetFolder
+      print 'Data folder:    ', fileDataFolder if ftpDataFolder is None else ftpDataFolder
    elif implementation == 'api':
       print 'Service URL:    ', apiServiceURL
+      print 'Chunk size (KB):', apiChunkSize
    print 'Temp   folder:  ', tempFolder
    print 'Simulation Mode:', simulate
    print 'Deletion Mode:  ', delete
+   print 'Sync State:     ', syncState, '(full check)' if fullCheck else ''
+   print 'Prune folders:  ', pruneFolders
+   print 'Jobs:           ', jobs
+   print 'Uploads:        ', uploads
+   print 'Cache size (MB):', cacheSize
+   print 'Metrics folder: ', metricsFolder
+   print 'Watch Mode:     ', watch, '(' + str(watchDelay) + 's delay)' if watch else ''
+   print 'Plan file:      ', planFile
+   if shard is not None:
+      print 'Shard:          ', str(shard[0] + 1) + '/' + str(shard[1])
+   elif shards > 1:
+      print 'Shards:         ', shards
    print 'Image Resize:   ', imgResize
    print 'Image Quality:  ', imgQuality
+   print 'Image Engine:   ', imgEngine
+   print 'Derivatives:    ', imgDerivatives
+   print 'Memory buffer:  ', str(imgBuffer) + ' MB' if imgBuffer > 0 else 'Off'
    print 'Video Quality:  ', videoQuality
+   print 'Video Encoder:  ', videoEncoder, '(' + str(videoWorkers) + ' workers x ' + str(videoThreads) + ' threads)'
    print '#################################'
 
-   if delete and not simulate:
+   # shards run unattended (the coordinator confirms deletion once for all shards)
+   if (shard is not None or shards > 1) and (watch or delete == "Prompt"):
+      print "[ERROR] Shards can't be used with watch mode or deletion mode 'Prompt'!"
+      sys.exit(1)
+   
+   # (in prompt mode, the list of elements to delete is confirmed at the end)
+   if delete and delete != "Prompt" and not simulate:
       print "Deletion has been enabled! All files in output folders that don't exist in corresponding input folders will be DELETED!"
       print "Please confirm by pressing ENTER or abort with CTRL+C"
       raw_input("")
-         
-   p = Folder2Piwigo(implementation,implSettings,sourceFolder,tempFolder,simulate,delete,imgResize,imgQuality,videoQuality)
-   p.run()
+   
+   # coordinator: one process per shard
+   if shard is None and shards > 1:
+      runShards(argv, shards, tempFolder, metricsFolder)
+      return
+   
+   # each shard writes its own plan
+   if shard is not None and planFile is not None:
+      root, ext = os.path.splitext(planFile)
+      planFile = root + "-shard-" + str(shard[0] + 1) + ext
+   
+   try:
+      p = Folder2Piwigo(implementation,implSettings,sourceFolder,tempFolder,simulate,delete,imgResize,imgQuality,videoQuality,syncState,fullCheck,jobs,uploads,imgEngine,videoEncoder,videoWorkers,videoThreads,cacheSize,metricsFolder,watch,watchDelay,planFile,shard,imgDerivatives,imgBuffer,pruneFolders)
+      p.run()
+   except PiwigoError as e:
+      print "  [ERROR] " + str(e)
+      sys.exit(1)
 
 
 # ===================================